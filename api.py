@@ -1,17 +1,30 @@
 import asyncio
+import time
 import urllib.parse
-from typing import Any, Dict, Optional, Unpack
+from typing import Any, AsyncIterator, Dict, Optional, Unpack
 
 import aiohttp
+import anyio
 from anyio import Path
 
+from metrics import DOWNLOAD_BYTES, REQUEST_LATENCY, REQUEST_STATUS, endpoint_label
 from models.api import (
+  IllustStats,
   SearchArtWorkResult,
   SearchIllustMetaResult,
   SearchUserResult,
+  UgoiraMeta,
+  UserProfileAllResult,
+  UserWorksResult,
 )
 from models.api_query import SearchParams, SearchParamsDict
 
+USER_WORKS_BATCH = 48  # profile/illusts 单次最多查询的作品数
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_USER_AGENT = "PixivApp/7.13.3 (Android 11; Pixel 5)"
+# 未登录时部分接口返回 200 + {"error": true, "message": "ログインが必要です"}，按语言不同文案不同
+LOGIN_REQUIRED_KEYWORDS = ("ログイン", "login", "log in", "登录", "登入")
+
 userAgent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36"
 
 
@@ -33,6 +46,18 @@ class APIResponseError(PixivAPIError):
   pass
 
 
+class AuthError(APIResponseError):
+  """登录失效 / 无权限（401、403，或 200 但提示需要登录）"""
+
+  pass
+
+
+class RateLimitedError(APIResponseError):
+  """请求过于频繁（429）"""
+
+  pass
+
+
 class PixivAPIParser:
   """
   Pixiv API 解析器
@@ -40,12 +65,14 @@ class PixivAPIParser:
   :param headers: 请求头，必须包含有效的 cookie
   :param proxy: 代理地址，例如 "http://127.0.0.1:10808"
   :param timeout: 请求超时时间（秒）
+  :param download_limit_per_host: 下载连接池中每个图片服务器的最大连接数
   """
 
   def __init__(
     self,
     headers: Dict[str, str] = {},
     timeout: int = 10,
+    download_limit_per_host: int = 8,
   ):
     base_headers = {
       "referer": "https://www.pixiv.net/",
@@ -54,7 +81,10 @@ class PixivAPIParser:
     }
     self.headers = {**base_headers, **headers}
     self.timeout = timeout
+    self.proxy: Optional[str] = None
+    self.download_limit_per_host = download_limit_per_host
     self._session: Optional[aiohttp.ClientSession] = None
+    self._download_session: Optional[aiohttp.ClientSession] = None
 
   async def __aenter__(self) -> "PixivAPIParser":
     return self
@@ -71,29 +101,55 @@ class PixivAPIParser:
       )
     return self._session
 
+  async def _get_download_session(self) -> aiohttp.ClientSession:
+    """获取或创建下载用的会话，所有下载共用一个连接池，复用到图片服务器的 TCP / TLS 连接"""
+    if self._download_session is None or self._download_session.closed:
+      self._download_session = aiohttp.ClientSession(
+        headers={"User-Agent": DOWNLOAD_USER_AGENT, "Referer": "https://www.pixiv.net/"},
+        connector=aiohttp.TCPConnector(limit_per_host=self.download_limit_per_host),
+      )
+    return self._download_session
+
   async def close(self) -> None:
     """关闭会话"""
     if self._session and not self._session.closed:
       await self._session.close()
+    if self._download_session and not self._download_session.closed:
+      await self._download_session.close()
 
-  async def _request(self, url: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+  async def _request(self, url: str, params: Optional[Dict[str, Any] | list[tuple[str, Any]]] = None) -> Dict[str, Any]:
     """
     执行异步 GET 请求并返回 JSON
     """
+    endpoint = endpoint_label(url)
+    status = "error"
+    start = time.perf_counter()
     try:
       session = await self._get_session()
       async with session.get(url, params=params, proxy=self.proxy) as response:
+        status = str(response.status)
         text = await response.text()
+        if response.status in (401, 403):
+          raise AuthError(f"登录失效或无权限: 状态码={response.status}")
+        if response.status == 429:
+          raise RateLimitedError("请求过于频繁")
         if response.status != 200:
           raise APIResponseError(f"API 请求失败: 状态码={response.status}, 内容={text}")
         data = await response.json()
         if data.get("error"):
-          raise APIResponseError(f"API 返回错误: {data.get('message')}")
+          message = str(data.get("message") or "")
+          if any(k in message.lower() for k in LOGIN_REQUIRED_KEYWORDS):
+            raise AuthError(f"登录失效: {message}")
+          raise APIResponseError(f"API 返回错误: {message}")
         return data
     except aiohttp.ClientError as e:
       raise NetworkError(f"网络请求失败: {e}") from e
     except asyncio.TimeoutError:
+      status = "timeout"
       raise NetworkError("请求超时")
+    finally:
+      REQUEST_LATENCY.observe(time.perf_counter() - start, endpoint=endpoint)
+      REQUEST_STATUS.inc(endpoint=endpoint, status=status)
 
   def set_token(self, token: str) -> None:
     """
@@ -105,6 +161,16 @@ class PixivAPIParser:
     """ """
     self.proxy = proxy
 
+  async def check_login(self) -> bool:
+    """
+    检查当前 cookie 是否处于登录状态
+    """
+    try:
+      await self._request("https://www.pixiv.net/ajax/user/extra", params={"lang": "zh"})
+      return True
+    except APIResponseError:
+      return False
+
   async def search_illust(self, illust_id: str):
     """
     搜索插画作品
@@ -115,6 +181,16 @@ class PixivAPIParser:
     raw = await self._request(base_url)
     return SearchIllustMetaResult.from_response(raw)
 
+  async def get_illust_stats(self, illust_id: str) -> IllustStats:
+    """
+    获取作品的公开统计（收藏 / 点赞 / 浏览）
+
+    :param illust_id: 插画 ID
+    """
+    base_url = f"https://www.pixiv.net/ajax/illust/{illust_id}"
+    raw = await self._request(base_url)
+    return IllustStats.from_response(raw)
+
   async def search_keyword(self, **kwargs: Unpack[SearchParamsDict]) -> SearchArtWorkResult:
     params = SearchParams(**kwargs)
 
@@ -173,6 +249,73 @@ class PixivAPIParser:
     raw = await self._request(base_url, params=params)
     return SearchUserResult.from_response(raw)
 
+  async def get_user_profile_all(self, user_id: int | str) -> UserProfileAllResult:
+    """
+    获取用户全部作品 ID（插画 + 漫画）
+
+    :param user_id: 用户 ID
+    """
+    base_url = f"https://www.pixiv.net/ajax/user/{user_id}/profile/all"
+    raw = await self._request(base_url, params={"lang": "zh"})
+    return UserProfileAllResult.from_response(raw)
+
+  async def get_user_works(
+    self,
+    user_id: int | str,
+    ids: list[str],
+    work_category: str = "illustManga",
+    lang: str = "zh",
+  ) -> UserWorksResult:
+    """
+    批量获取用户作品详情
+
+    :param user_id: 用户 ID
+    :param ids: 作品 ID 列表（单次不超过 USER_WORKS_BATCH 个）
+    :param work_category: 作品类别 (illustManga / illust / manga)
+    :param lang: 返回语言
+    """
+    base_url = f"https://www.pixiv.net/ajax/user/{user_id}/profile/illusts"
+    params: list[tuple[str, Any]] = [("ids[]", i) for i in ids]
+    params += [("work_category", work_category), ("is_first_page", 0), ("lang", lang)]
+    raw = await self._request(base_url, params=params)
+    return UserWorksResult.from_response(raw)
+
+  async def get_ugoira_meta(self, illust_id: str) -> UgoiraMeta:
+    """
+    获取动图（ugoira）帧信息
+
+    :param illust_id: 插画 ID
+    """
+    base_url = f"https://www.pixiv.net/ajax/illust/{illust_id}/ugoira_meta"
+    raw = await self._request(base_url)
+    return UgoiraMeta.from_response(raw)
+
+  async def iter_download(
+    self,
+    url,
+    headers: Dict[str, str] = {},
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+  ) -> AsyncIterator[bytes]:
+    """
+    流式下载，逐块返回内容
+
+    :param url: 资源 URL
+    :param headers: 请求头
+    :param chunk_size: 每次读取的字节数
+    """
+    session = await self._get_download_session()
+    async with session.get(url, headers=headers, proxy=self.proxy) as resp:
+      if resp.status != 200:
+        text = await resp.text()
+        raise Exception(f"下载失败: 状态码={resp.status}, 内容={text}")
+
+      while True:
+        chunk = await resp.content.read(chunk_size)
+        if not chunk:
+          break
+        DOWNLOAD_BYTES.inc(len(chunk))
+        yield chunk
+
   async def download(self, url, filepath: Path, headers: Dict[str, str] = {}):
     """
     下载 Pixiv 图片
@@ -181,22 +324,13 @@ class PixivAPIParser:
     :param filepath: 保存路径
     :param headers: 请求头
     """
-    headers = {
-      "User-Agent": "PixivApp/7.13.3 (Android 11; Pixel 5)",
-      "Referer": "https://www.pixiv.net/",
-      **headers,
-    }
-
-    async with aiohttp.ClientSession(headers=headers, proxy=self.proxy) as session:
-      async with session.get(url) as resp:
-        if resp.status != 200:
-          text = await resp.text()
-          raise Exception(f"下载失败: 状态码={resp.status}, 内容={text}")
-
-        await filepath.parent.mkdir(parents=True, exist_ok=True)
-        with open(filepath, "wb") as f:
-          while True:
-            chunk = await resp.content.read(1024)
-            if not chunk:
-              break
-            f.write(chunk)
+    f = None
+    try:
+      async for chunk in self.iter_download(url, headers):
+        if f is None:
+          await filepath.parent.mkdir(parents=True, exist_ok=True)
+          f = await anyio.open_file(filepath, "wb")
+        await f.write(chunk)
+    finally:
+      if f is not None:
+        await f.aclose()
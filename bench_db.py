@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from db import ImageDB
+from models.api import Illust, IllustMeta
+from sql import dialect
+from utils import batch_create_images
+
+TAG_POOL = [f"tag{i}" for i in range(2000)]
+
+
+def fake_illust(n: int, rng: random.Random) -> Illust:
+  created = datetime(2020, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=n)
+  # 头部 tag 更热门，模拟真实分布
+  tags = list({TAG_POOL[min(int(rng.paretovariate(1.2)) - 1, len(TAG_POOL) - 1)] for _ in range(rng.randint(3, 10))})
+  illust = Illust.from_dict(
+    {
+      "id": str(100000000 + n),
+      "title": f"title {n}",
+      "tags": tags,
+      "userId": str(rng.randint(1, n // 10 + 1)),
+      "userName": "user",
+      "pageCount": rng.choice((1, 1, 1, 2, 3)),
+      "createDate": created.isoformat(),
+      "updateDate": created.isoformat(),
+    }
+  )
+  url = f"https://i.pximg.net/img-original/img/{n}_p0.jpg"
+  illust.meta = [
+    IllustMeta.from_dict({"width": 1000, "height": 1000, "urls": {"original": url}}) for _ in range(illust.page_count)
+  ]
+  return illust
+
+
+async def timed(name: str, coro_factory, repeat: int = 20):
+  start = time.perf_counter()
+  for _ in range(repeat):
+    result = await coro_factory()
+  elapsed = (time.perf_counter() - start) / repeat
+  print(f"  {name:<28} {elapsed * 1000:9.3f} ms")
+  return result
+
+
+async def run(db_url: str, count: int, seed: int) -> None:
+  """
+  数据库基准：写入合成数据后测量常用查询，用不同的连接串分别运行即可对比方言
+
+  :param db_url: 数据库连接串，例如 sqlite://bench.sqlite3 或 postgres://...
+  :param count: 写入的作品数
+  :param seed: 随机种子
+  """
+  db = ImageDB()
+  await db.connect(db_url)
+  try:
+    print(f"⏱️ {dialect()} @ {db_url}")
+
+    rng = random.Random(seed)
+    illusts = [fake_illust(n, rng) for n in range(count)]
+    start = time.perf_counter()
+    for i in range(0, len(illusts), 500):
+      await batch_create_images(illusts[i : i + 500], batch_size=500)
+    print(f"  {'ingest':<28} {time.perf_counter() - start:9.3f} s  ({count} 作品)")
+
+    hot, cold = TAG_POOL[0], TAG_POOL[500]
+    await timed("get_image_count", db.get_image_count)
+    await timed("count_images_by_tag", lambda: db.count_images_by_tag(hot))
+    await timed("get_top_tags", lambda: db.get_top_tags(30))
+    await timed("get_images_by_tag hot p1", lambda: db.get_images_by_tag(hot))
+    await timed("get_images_by_tag cold p1", lambda: db.get_images_by_tag(cold))
+    await timed("get_images_by_tag hot p50", lambda: db.get_images_by_tag(hot, page=50))
+    page = await timed("keyset recent", lambda: db.get_images_keyset(None, None, 20, ("id", "created")))
+    cursor = (page[-1]["created"], page[-1]["id"])
+    await timed("keyset recent next", lambda: db.get_images_keyset(None, cursor, 20, ("id", "created")))
+    await timed("keyset two tags", lambda: db.get_images_keyset({"tags": [hot, TAG_POOL[1]]}, None, 20, ("id",)))
+    await timed("images_by_user", lambda: db.get_images_by_user("1"))
+    await timed("title search", lambda: db.get_images_keyset({"keyword": "title 99"}, None, 20, ("id",)), repeat=5)
+    stats = [(str(100000000 + n), n, n * 10) for n in range(200)]
+    await timed("update_stats x200", lambda: db.update_stats(stats), repeat=5)
+
+  finally:
+    await db.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="数据库查询基准")
+  parser.add_argument("db_url")
+  parser.add_argument("-n", "--count", type=int, default=20000)
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+  asyncio.run(run(args.db_url, args.count, args.seed))
+
+
+if __name__ == "__main__":
+  main()
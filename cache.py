@@ -0,0 +1,337 @@
+import asyncio
+import contextlib
+import functools
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Iterable, Optional
+from urllib.parse import urlparse
+
+from db import ImageDB, ImageFilter
+from metrics import REGISTRY
+from models.db import Image
+from utils import add_insert_listener
+
+CACHE_HITS = REGISTRY.counter("pixiv_cache_hits_total", "缓存命中次数", ("tier",))
+CACHE_MISSES = REGISTRY.counter("pixiv_cache_misses_total", "缓存未命中次数")
+
+_MISSING = object()
+TOP_KEYS = "keys:top"  # Redis 集合，记录各进程写入过的 top:{limit} 键，失效时一并删除
+
+
+class MemoryCache:
+  """
+  进程内 TTL + LRU 缓存
+
+  :param maxsize: 最大条目数
+  :param ttl: 默认过期时间（秒）
+  """
+
+  def __init__(self, maxsize: int = 1024, ttl: float = 30):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+  def get(self, key: str) -> Any:
+    item = self._data.get(key)
+    if item is None:
+      return _MISSING
+    expires, value = item
+    if expires < time.monotonic():
+      del self._data[key]
+      return _MISSING
+    self._data.move_to_end(key)
+    return value
+
+  def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+    self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+    self._data.move_to_end(key)
+    while len(self._data) > self.maxsize:
+      self._data.popitem(last=False)
+
+  def delete(self, *keys: str) -> None:
+    for key in keys:
+      self._data.pop(key, None)
+
+  def delete_prefix(self, prefixes: tuple[str, ...]) -> None:
+    if prefixes:
+      for key in [k for k in self._data if k.startswith(prefixes)]:
+        del self._data[key]
+
+  def clear(self) -> None:
+    self._data.clear()
+
+
+class RedisCache:
+  """
+  极简 Redis 协议（RESP）客户端，只实现 GET / SET PX / DEL / SADD / SMEMBERS
+
+  兼容任何说 Redis 协议的服务（redis / valkey / dragonfly），不引入额外依赖
+
+  :param url: redis://[:password@]host:port/db
+  :param prefix: 键前缀
+  :param timeout: 建连和每次请求 / 响应的超时（秒），Redis 卡住时缓存读写失败而不是拖住调用方
+  """
+
+  def __init__(self, url: str, prefix: str = "pixiv:", timeout: float = 1.0):
+    parsed = urlparse(url)
+    self.host = parsed.hostname or "127.0.0.1"
+    self.port = parsed.port or 6379
+    self.password = parsed.password
+    self.db = int(parsed.path.lstrip("/") or 0)
+    self.prefix = prefix
+    self.timeout = timeout
+    self._reader: Optional[asyncio.StreamReader] = None
+    self._writer: Optional[asyncio.StreamWriter] = None
+    self._lock = asyncio.Lock()
+
+  async def _connect(self) -> None:
+    self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+    if self.password:
+      await self._command("AUTH", self.password)
+    if self.db:
+      await self._command("SELECT", str(self.db))
+
+  async def close(self) -> None:
+    if self._writer:
+      writer = self._writer
+      self._drop()
+      with contextlib.suppress(Exception):
+        await asyncio.wait_for(writer.wait_closed(), self.timeout)
+
+  def _drop(self) -> None:
+    """丢弃当前连接，下次调用时重连"""
+    if self._writer:
+      self._writer.close()
+    self._reader = self._writer = None
+
+  async def _read_reply(self) -> Any:
+    assert self._reader is not None
+    line = await self._reader.readline()
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+      return payload.decode()
+    if kind == b"-":
+      raise RuntimeError(f"Redis 错误: {payload.decode()}")
+    if kind == b":":
+      return int(payload)
+    if kind == b"$":
+      size = int(payload)
+      if size < 0:
+        return None
+      data = await self._reader.readexactly(size + 2)
+      return data[:-2]
+    if kind == b"*":
+      return [await self._read_reply() for _ in range(int(payload))]
+    raise RuntimeError(f"无法解析的 Redis 响应: {line!r}")
+
+  async def _command(self, *args: str | bytes) -> Any:
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+      data = arg.encode() if isinstance(arg, str) else arg
+      parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+    assert self._writer is not None
+    self._writer.write(b"".join(parts))
+    await self._writer.drain()
+    return await self._read_reply()
+
+  async def _call(self, *args: str | bytes) -> Any:
+    async with self._lock:
+      try:
+        if self._writer is None or self._writer.is_closing():
+          await asyncio.wait_for(self._connect(), self.timeout)
+        return await asyncio.wait_for(self._command(*args), self.timeout)
+      except BaseException:
+        # 超时 / 取消 / 断线后连接上可能还留着半个响应，不能再复用
+        self._drop()
+        raise
+
+  async def get(self, key: str) -> Any:
+    raw = await self._call("GET", self.prefix + key)
+    return _MISSING if raw is None else json.loads(raw)
+
+  async def set(self, key: str, value: Any, ttl: float) -> None:
+    await self._call("SET", self.prefix + key, json.dumps(value, ensure_ascii=False), "PX", str(int(ttl * 1000)))
+
+  async def delete(self, *keys: str) -> None:
+    if keys:
+      await self._call("DEL", *(self.prefix + k for k in keys))
+
+  async def sadd(self, key: str, *members: str) -> None:
+    if members:
+      await self._call("SADD", self.prefix + key, *members)
+
+  async def smembers(self, key: str) -> list[str]:
+    return [m.decode() for m in await self._call("SMEMBERS", self.prefix + key)]
+
+
+class CachedImageDB(ImageDB):
+  """
+  带两级缓存的 ImageDB
+
+  热点读接口先查进程内缓存，再查 Redis（可选），都未命中才查数据库；
+  同一个键的并发未命中只会查一次数据库。入库时按受影响的 tag 失效本进程缓存和 Redis，
+  因此写入端（爬取 / 同步入口）也要用 CachedImageDB 并配置同一个 redis_url
+
+  只有 Redis 是跨进程失效的：其他进程的进程内缓存收不到通知，最迟 local_ttl 后过期，
+  因此 local_ttl 应保持较短；只放进程内缓存的首页列表同理
+
+  :param local_ttl: 进程内缓存过期时间（秒）
+  :param shared_ttl: Redis 缓存过期时间（秒）
+  :param redis_url: Redis 地址，None 表示只用进程内缓存
+  :param maxsize: 进程内缓存最大条目数
+  """
+
+  def __init__(
+    self,
+    local_ttl: float = 5,
+    shared_ttl: float = 60,
+    redis_url: Optional[str] = None,
+    maxsize: int = 4096,
+  ):
+    super().__init__()
+    self.local = MemoryCache(maxsize=maxsize, ttl=local_ttl)
+    self.shared = RedisCache(redis_url) if redis_url else None
+    self.shared_ttl = shared_ttl
+    self._inflight: dict[str, asyncio.Task] = {}
+    # 记录已缓存过的参数，失效时据此拼出所有相关键
+    self._page_sizes: set[int] = set()
+    self._top_limits: set[int] = set()
+    self._first_page_limits: set[int] = set()
+
+  async def connect(self, db_url: Optional[str] = None, read_only: bool = False):
+    await super().connect(db_url, read_only)
+    add_insert_listener(self.on_images_inserted)
+
+  async def close(self) -> None:
+    if self.shared:
+      await self.shared.close()
+    await super().close()
+
+  async def _cached(
+    self, key: str, loader: Callable[[], Awaitable[Any]], shared: bool = True, index: Optional[str] = None
+  ) -> Any:
+    """
+    :param key: 缓存键
+    :param loader: 未命中时的加载函数
+    :param shared: 是否放入 Redis
+    :param index: 写入 Redis 后把键登记到该集合，供其他进程失效时查找
+    """
+    value = self.local.get(key)
+    if value is not _MISSING:
+      CACHE_HITS.inc(tier="local")
+      return value
+
+    task = self._inflight.get(key)
+    if task is None:
+      task = asyncio.create_task(self._load(key, loader, shared, index))
+      self._inflight[key] = task
+      task.add_done_callback(functools.partial(self._load_done, key))
+    # 加载在独立任务中进行，任何一个调用方被取消都不影响其他等待者
+    return await asyncio.shield(task)
+
+  def _load_done(self, key: str, task: asyncio.Task) -> None:
+    if self._inflight.get(key) is task:
+      del self._inflight[key]
+    if not task.cancelled():
+      # 等待者全部取消时避免 "exception was never retrieved"
+      task.exception()
+
+  async def _load(
+    self, key: str, loader: Callable[[], Awaitable[Any]], shared: bool, index: Optional[str] = None
+  ) -> Any:
+    value = _MISSING
+    if shared and self.shared:
+      try:
+        value = await self.shared.get(key)
+      except Exception as e:
+        print(f"⚠️ 读取 Redis 缓存失败：{e}")
+      if value is not _MISSING:
+        CACHE_HITS.inc(tier="shared")
+
+    if value is _MISSING:
+      CACHE_MISSES.inc()
+      value = await loader()
+      if shared and self.shared:
+        try:
+          await self.shared.set(key, value, self.shared_ttl)
+          if index:
+            await self.shared.sadd(index, key)
+        except Exception as e:
+          print(f"⚠️ 写入 Redis 缓存失败：{e}")
+
+    self.local.set(key, value)
+    return value
+
+  async def get_image_count(self) -> int:
+    return await self._cached("count", super().get_image_count)
+
+  async def get_stats(self) -> dict[str, Any]:
+    return await self._cached("stats", super().get_stats)
+
+  async def count_images_by_tag(self, tag: str) -> int:
+    return await self._cached(f"tag:{tag}:count", lambda: super(CachedImageDB, self).count_images_by_tag(tag))
+
+  async def get_top_tags(self, limit: int = 30) -> list[tuple[str, int]]:
+    self._top_limits.add(limit)
+    rows = await self._cached(f"top:{limit}", lambda: super(CachedImageDB, self).get_top_tags(limit), index=TOP_KEYS)
+    return [tuple(row) for row in rows]
+
+  async def get_images_by_tag(self, tag: str, page: int = 1, page_size: int = 20) -> list[Image]:
+    if page != 1:
+      return await super().get_images_by_tag(tag, page, page_size)
+    # 模型对象不跨进程共享，只放进程内缓存
+    self._page_sizes.add(page_size)
+    return await self._cached(
+      f"tag:{tag}:page1:{page_size}",
+      lambda: super(CachedImageDB, self).get_images_by_tag(tag, 1, page_size),
+      shared=False,
+    )
+
+  async def get_images_keyset(
+    self,
+    filters: Optional[ImageFilter] = None,
+    cursor: Optional[tuple[datetime, int]] = None,
+    limit: int = 20,
+    columns: Iterable[str] = (),
+  ) -> list[dict[str, Any]]:
+    # 只缓存最热的首页：最新作品 / 单个 tag
+    filters = filters or {}
+    tags = filters.get("tags") or []
+    other = {k: v for k, v in filters.items() if k != "tags" and v is not None}
+    if cursor is not None or other or len(tags) > 1:
+      return await super().get_images_keyset(filters, cursor, limit, columns)
+
+    columns = tuple(columns)
+    self._first_page_limits.add(limit)
+    key = f"tag:{tags[0]}:first:{limit}" if tags else f"recent:{limit}"
+    return await self._cached(
+      f"{key}:{hash(columns)}",
+      lambda: super(CachedImageDB, self).get_images_keyset(filters, None, limit, columns),
+      shared=False,
+    )
+
+  async def invalidate_tags(self, tags: set[str]) -> None:
+    """失效与这些 tag 相关的缓存，以及全局计数 / 仪表盘统计 / 热门 tag / 最新作品"""
+    keys = ["count", "stats", *(f"top:{limit}" for limit in self._top_limits)]
+    for tag in tags:
+      keys.append(f"tag:{tag}:count")
+      keys.extend(f"tag:{tag}:page1:{size}" for size in self._page_sizes)
+    # 首页键带列哈希，按前缀删除进程内缓存
+    prefixes = tuple(f"recent:{limit}:" for limit in self._first_page_limits) + tuple(
+      f"tag:{tag}:first:" for tag in tags
+    )
+    self.local.delete_prefix(prefixes)
+    self.local.delete(*keys)
+    if self.shared:
+      try:
+        # 其他进程用过的 top:{limit} 本进程不一定知道，从登记集合里取
+        keys.extend(await self.shared.smembers(TOP_KEYS))
+        await self.shared.delete(*keys)
+      except Exception as e:
+        print(f"⚠️ 失效 Redis 缓存失败：{e}")
+
+  async def on_images_inserted(self, images: list[Image]) -> None:
+    tags = {tag for image in images for tag in image.tags}
+    await self.invalidate_tags(tags)
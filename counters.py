@@ -0,0 +1,129 @@
+from collections import Counter as Tally
+from typing import Any, Optional
+
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.transactions import in_transaction
+
+from models.db import Counter, Image, TagCount
+from sql import is_sqlite, sql_params
+
+IMAGE_TOTAL = "images"
+
+
+async def apply_image_deltas(images: list[Image], conn: BaseDBAsyncClient) -> None:
+  """
+  把新插入的图片计入 tag 计数与总数（需在插入所在的事务中调用）
+
+  :param images: 本批实际新增的图片
+  :param conn: 事务连接
+  """
+  if not images:
+    return
+
+  tags = Tally(tag for image in images for tag in set(image.tags))
+  if tags:
+    rows, values = [], []
+    for tag, delta in tags.items():
+      a, b = sql_params(2, len(values) + 1)
+      rows.append(f"({a}, {b})")
+      values.extend([tag, delta])
+    await conn.execute_query(
+      f"""
+      INSERT INTO tag_count (tag, count) VALUES {", ".join(rows)}
+      ON CONFLICT (tag) DO UPDATE SET count = tag_count.count + EXCLUDED.count
+      """,
+      values,
+    )
+
+  a, b = sql_params(2)
+  await conn.execute_query(
+    f"""
+    INSERT INTO counter (name, value) VALUES ({a}, {b})
+    ON CONFLICT (name) DO UPDATE SET value = counter.value + EXCLUDED.value
+    """,
+    [IMAGE_TOTAL, len(images)],
+  )
+
+
+async def rebuild() -> None:
+  """从 image 表全量重算计数（首次启用或数据被手工修改后使用）"""
+  tags: Tally[str] = Tally()
+  total = 0
+  last_id = 0
+  while True:
+    rows = await Image.filter(id__gt=last_id).order_by("id").limit(10000).values_list("id", "tags")
+    if not rows:
+      break
+    for _, image_tags in rows:
+      tags.update(set(image_tags))
+    total += len(rows)
+    last_id = rows[-1][0]
+
+  async with in_transaction() as conn:
+    await TagCount.all().using_db(conn).delete()
+    await TagCount.bulk_create([TagCount(tag=t, count=c) for t, c in tags.items()], batch_size=1000, using_db=conn)
+    await Counter.filter(name=IMAGE_TOTAL).using_db(conn).delete()
+    await Counter.create(name=IMAGE_TOTAL, value=total, using_db=conn)
+
+
+async def ensure_initialized() -> None:
+  """计数表为空时回填一次"""
+  if not await Counter.filter(name=IMAGE_TOTAL).exists():
+    print("🔢 初始化计数表…")
+    await rebuild()
+
+
+async def get_total() -> int:
+  row = await Counter.get_or_none(name=IMAGE_TOTAL)
+  return row.value if row else 0
+
+
+async def get_tag_count(tag: str) -> int:
+  row = await TagCount.get_or_none(tag=tag)
+  return row.count if row else 0
+
+
+async def get_top_tags(limit: int = 30) -> list[tuple[str, int]]:
+  rows = await TagCount.filter(count__gt=0).order_by("-count").limit(limit).values_list("tag", "count")
+  return [(tag, count) for tag, count in rows]
+
+
+async def get_all_tags() -> list[str]:
+  return await TagCount.filter(count__gt=0).values_list("tag", flat=True)
+
+
+async def approx_total() -> Optional[int]:
+  """基于 planner 统计的总行数估算（ANALYZE 之后才准确），sqlite 直接读计数表"""
+  if is_sqlite():
+    return await get_total()
+  rows = await Image._meta.db.execute_query_dict("SELECT reltuples::bigint AS n FROM pg_class WHERE relname = 'image'")
+  if not rows or rows[0]["n"] < 0:
+    return None
+  return rows[0]["n"]
+
+
+async def approx_distinct_users() -> Optional[int]:
+  """基于 pg_stats 的画师数估算，n_distinct 为负数时表示占总行数的比例；sqlite 走 user_id 索引精确计算"""
+  if is_sqlite():
+    rows = await Image._meta.db.execute_query_dict("SELECT COUNT(DISTINCT user_id) AS n FROM image")
+    return rows[0]["n"]
+  rows = await Image._meta.db.execute_query_dict(
+    "SELECT n_distinct FROM pg_stats WHERE tablename = 'image' AND attname = 'user_id'"
+  )
+  if not rows:
+    return None
+  n_distinct = rows[0]["n_distinct"]
+  if n_distinct >= 0:
+    return int(n_distinct)
+  total = await approx_total()
+  return int(-n_distinct * total) if total else None
+
+
+async def dashboard_stats() -> dict[str, Any]:
+  """仪表盘用的快速统计"""
+  return {
+    "images": await get_total(),
+    "images_approx": await approx_total(),
+    "users_approx": await approx_distinct_users(),
+    "tags": await TagCount.filter(count__gt=0).count(),
+  }
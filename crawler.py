@@ -0,0 +1,211 @@
+import asyncio
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from api import USER_WORKS_BATCH
+from db import ImageDB
+from downloader import PixivDownloader
+from metrics import QUEUE_DEPTH, span
+from models.api import Illust, User
+from utils import batch_create_images
+
+IngestFunc = Callable[[list[Illust]], Awaitable[None]]
+
+
+@dataclass
+class CrawlStats:
+  users: int = 0  # 已展开的用户数
+  discovered: int = 0  # 发现的用户数
+  illusts: int = 0  # 入库的作品数
+  failed: int = 0  # 失败的用户数
+
+
+class FollowCrawler:
+  """
+  关注关系图爬虫
+
+  从种子用户出发，按层 BFS 展开 search_following，把每个被关注用户附带的近期作品送入入库流程
+
+  :param downloader: 已登录的下载器
+  :param max_depth: 展开深度，1 表示只展开种子用户的关注列表
+  :param concurrency: 同时展开的用户数
+  :param page_size: 每次请求关注列表的数量
+  :param max_users: 最多展开的用户数（None 为不限制）
+  :param ingest: 入库函数，默认 batch_create_images
+  """
+
+  def __init__(
+    self,
+    downloader: PixivDownloader,
+    max_depth: int = 1,
+    concurrency: int = 4,
+    page_size: int = 24,
+    max_users: Optional[int] = None,
+    ingest: IngestFunc = batch_create_images,
+  ):
+    self.downloader = downloader
+    self.max_depth = max_depth
+    self.concurrency = concurrency
+    self.page_size = page_size
+    self.max_users = max_users
+    self.ingest = ingest
+    self.visited: set[str] = set()
+    self.stats = CrawlStats()
+
+  async def iter_following(self, user_id: int | str) -> AsyncIterator[User]:
+    """分页遍历用户的全部关注"""
+    offset = 0
+    while True:
+      result = await self.downloader.parser.search_following(int(user_id), offset=offset, limit=self.page_size)
+      if not result.users:
+        return
+      for user in result.users:
+        yield user
+      offset += len(result.users)
+      if offset >= result.total:
+        return
+
+  async def _expand(self, user_id: str, collect_next: bool) -> list[str]:
+    """展开单个用户：入库其关注用户的作品，返回下一层待展开的用户"""
+    next_level: list[str] = []
+    illusts: list[Illust] = []
+    async for user in self.iter_following(user_id):
+      # 同一画师可能被多人关注，只在第一次发现时入库
+      if user.user_id in self.visited:
+        continue
+      self.visited.add(user.user_id)
+      self.stats.discovered += 1
+      illusts.extend(user.illusts)
+      if collect_next:
+        next_level.append(user.user_id)
+
+    if illusts:
+      with span("fetch_meta"):
+        illusts = await self.downloader.fetch_metas(illusts, strict=False)
+      with span("db_write"):
+        await self.ingest(illusts)
+      self.stats.illusts += len(illusts)
+    return next_level
+
+  async def crawl(self, seed_user_id: int | str) -> CrawlStats:
+    """
+    从种子用户开始爬取
+
+    :param seed_user_id: 种子用户 ID
+    """
+    seed = str(seed_user_id)
+    self.visited.add(seed)
+    level = [seed]
+    sem = asyncio.Semaphore(self.concurrency)
+
+    for depth in range(self.max_depth):
+      if self.max_users is not None:
+        level = level[: max(self.max_users - self.stats.users, 0)]
+      if not level:
+        break
+
+      print(f"🕸️ 第 {depth + 1}/{self.max_depth} 层，待展开 {len(level)} 个用户")
+      collect_next = depth + 1 < self.max_depth
+      QUEUE_DEPTH.set(len(level), queue="follow")
+
+      async def worker(user_id: str) -> list[str]:
+        async with sem:
+          try:
+            return await self._expand(user_id, collect_next)
+          except Exception as e:
+            print(f"❌ 展开用户 {user_id} 失败：{e}")
+            self.stats.failed += 1
+            return []
+          finally:
+            self.stats.users += 1
+            QUEUE_DEPTH.dec(queue="follow")
+
+      results = await asyncio.gather(*(worker(user_id) for user_id in level))
+      level = [user_id for users in results for user_id in users]
+
+    return self.stats
+
+
+class UserCrawler:
+  """
+  用户全部作品爬虫
+
+  一次 profile/all 拿到用户全部作品 ID，剔除已入库的作品后按批次请求详情，再走正常入库流程
+
+  profile/illusts 只返回缩略图链接，原图的扩展名 (jpg / png / gif) 无法从中推出，
+  所以每个作品仍需一次 /pages 请求补全原图链接；已入库的作品不会再请求
+
+  :param downloader: 已登录的下载器
+  :param db: 数据库，用于过滤已入库作品
+  :param chunk_size: 每次批量查询详情的作品数
+  :param concurrency: 同时同步的用户数
+  :param ingest: 入库函数，默认 batch_create_images
+  """
+
+  def __init__(
+    self,
+    downloader: PixivDownloader,
+    db: ImageDB,
+    chunk_size: int = USER_WORKS_BATCH,
+    concurrency: int = 2,
+    ingest: IngestFunc = batch_create_images,
+  ):
+    self.downloader = downloader
+    self.db = db
+    self.chunk_size = min(chunk_size, USER_WORKS_BATCH)
+    self.concurrency = concurrency
+    self.ingest = ingest
+    self.stats = CrawlStats()
+
+  async def list_new_ids(self, user_id: int | str) -> list[str]:
+    """列出用户尚未入库的作品 ID（新到旧）"""
+    with span("user_profile"):
+      profile = await self.downloader.parser.get_user_profile_all(user_id)
+    ids = profile.all_ids
+    existing = await self.db.get_existing_img_ids(ids)
+    return [i for i in ids if i not in existing]
+
+  async def crawl(self, user_id: int | str) -> int:
+    """
+    同步单个用户的全部作品
+
+    :param user_id: 用户 ID
+    :return: 本次入库的作品数
+    """
+    new_ids = await self.list_new_ids(user_id)
+    if not new_ids:
+      return 0
+
+    print(f"👤 用户 {user_id} 新作品 {len(new_ids)} 个")
+    count = 0
+    for start in range(0, len(new_ids), self.chunk_size):
+      chunk = new_ids[start : start + self.chunk_size]
+      with span("user_works"):
+        works = await self.downloader.parser.get_user_works(user_id, chunk)
+      # 详情接口没有原图链接，见类注释
+      with span("fetch_meta"):
+        illusts = await self.downloader.fetch_metas(works.Illusts, strict=False)
+      if illusts:
+        with span("db_write"):
+          await self.ingest(illusts)
+        count += len(illusts)
+    return count
+
+  async def crawl_many(self, user_ids: list[int | str]) -> CrawlStats:
+    """并发同步多个用户"""
+    sem = asyncio.Semaphore(self.concurrency)
+    QUEUE_DEPTH.set(len(user_ids), queue="user")
+
+    async def worker(user_id: int | str):
+      async with sem:
+        try:
+          self.stats.illusts += await self.crawl(user_id)
+        except Exception as e:
+          print(f"❌ 同步用户 {user_id} 失败：{e}")
+          self.stats.failed += 1
+        finally:
+          self.stats.users += 1
+          QUEUE_DEPTH.dec(queue="user")
+
+    await asyncio.gather(*(worker(user_id) for user_id in user_ids))
+    return self.stats
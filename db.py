@@ -1,17 +1,69 @@
 import os
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Iterable, Optional, TypedDict
 
 from dotenv import load_dotenv
+from pypika_tortoise.terms import BasicCriterion, Function, LiteralValue, ValueWrapper
 from tortoise import Tortoise
+from tortoise.contrib.postgres.search import Comp
+from tortoise.expressions import F, Q, ResolveContext, Subquery
+from tortoise.query_utils import QueryModifier
+from tortoise.queryset import QuerySet
 
+import counters
 from models.db import Image
+from models.sqlite import ImageTag
+from sql import is_sqlite, sql_params
 
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 
+SQLITE_PRAGMAS = """
+  PRAGMA journal_mode = WAL;
+  PRAGMA synchronous = NORMAL;
+  PRAGMA temp_store = MEMORY;
+  PRAGMA cache_size = -65536;
+  PRAGMA mmap_size = 268435456;
+  PRAGMA busy_timeout = 5000;
+"""
+
+# image_tag 倒排表由触发器维护，写入路径与 postgres 完全一致
+SQLITE_TAG_TRIGGERS = """
+  CREATE TRIGGER IF NOT EXISTS trg_image_tag_insert AFTER INSERT ON image BEGIN
+    INSERT OR IGNORE INTO image_tag (image_id, tag) SELECT NEW.id, value FROM json_each(NEW.tags);
+  END;
+  CREATE TRIGGER IF NOT EXISTS trg_image_tag_update AFTER UPDATE OF tags ON image BEGIN
+    DELETE FROM image_tag WHERE image_id = OLD.id;
+    INSERT OR IGNORE INTO image_tag (image_id, tag) SELECT NEW.id, value FROM json_each(NEW.tags);
+  END;
+  CREATE TRIGGER IF NOT EXISTS trg_image_tag_delete AFTER DELETE ON image BEGIN
+    DELETE FROM image_tag WHERE image_id = OLD.id;
+  END;
+"""
+
+
+def model_modules(db_url: str) -> list[str]:
+  modules = ["models.db"]
+  if db_url.startswith("sqlite"):
+    modules.append("models.sqlite")
+  return modules
+
+
 async def create_custom_indexes():
   conn = Image._meta.db
 
+  if is_sqlite():
+    await conn.execute_script(SQLITE_TAG_TRIGGERS)
+    await conn.execute_script("CREATE INDEX IF NOT EXISTS idx_image_created_id ON image (created, id);")
+    # 触发器建立之前已有的数据需要回填一次
+    rows = await conn.execute_query_dict("SELECT EXISTS (SELECT 1 FROM image_tag) AS filled")
+    if not rows[0]["filled"]:
+      await conn.execute_script(
+        "INSERT OR IGNORE INTO image_tag (image_id, tag) SELECT image.id, value FROM image, json_each(image.tags);"
+      )
+    return
+
   try:
     # 添加IF NOT EXISTS避免重复创建
     await conn.execute_script("""
@@ -27,56 +79,308 @@ async def create_custom_indexes():
     print(f"索引可能已存在，忽略错误: {str(e)}")
 
 
+async def migrate_columns():
+  """generate_schemas 不会给已有表加列，这里补齐后续新增的字段"""
+  conn = Image._meta.db
+  if is_sqlite():
+    # sqlite 的 ADD COLUMN 不支持 IF NOT EXISTS
+    columns = {row["name"] for row in await conn.execute_query_dict("PRAGMA table_info(image)")}
+    if "phash" not in columns:
+      await conn.execute_script("ALTER TABLE image ADD COLUMN phash VARCHAR(16) NOT NULL DEFAULT '';")
+    if "refresh_failures" not in columns:
+      await conn.execute_script("ALTER TABLE image ADD COLUMN refresh_failures INT NOT NULL DEFAULT 0;")
+    if "stats_refreshed_at" not in columns:
+      await conn.execute_script("ALTER TABLE image ADD COLUMN stats_refreshed_at TIMESTAMP;")
+      await backfill_stats_refreshed_at()
+    return
+
+  columns = {
+    row["column_name"]
+    for row in await conn.execute_query_dict(
+      "SELECT column_name FROM information_schema.columns WHERE table_name = 'image'"
+    )
+  }
+  await conn.execute_script("""
+          ALTER TABLE image ADD COLUMN IF NOT EXISTS phash VARCHAR(16) NOT NULL DEFAULT '';
+          ALTER TABLE image ADD COLUMN IF NOT EXISTS refresh_failures INT NOT NULL DEFAULT 0;
+          ALTER TABLE image ADD COLUMN IF NOT EXISTS stats_refreshed_at TIMESTAMPTZ;
+      """)
+  if "stats_refreshed_at" not in columns:
+    await backfill_stats_refreshed_at()
+
+
+async def backfill_stats_refreshed_at():
+  """旧库没有刷新标记：已有浏览数或失败记录的作品视为刷新过，避免加列后整库重新进入 new 层级"""
+  await (
+    Image.filter(stats_refreshed_at__isnull=True)
+    .filter(Q(views__gt=0) | Q(refresh_failures__gt=0))
+    .update(stats_refreshed_at=F("updated"))
+  )
+
+
+def filter_tags(query: QuerySet[Image], tags: list[str]) -> QuerySet[Image]:
+  """筛选同时包含所有 tag 的图片；postgres 走 jsonb GIN 索引，sqlite 走 image_tag 倒排表"""
+  if not is_sqlite():
+    return query.filter(tags__contains=tags)
+
+  for tag in tags:
+    query = query.filter(id__in=Subquery(ImageTag.filter(tag=tag).values("image_id")))
+  return query
+
+
+class TitleSearch(Q):
+  """
+  postgres 标题全文检索: to_tsvector('simple', title) @@ plainto_tsquery('simple', 关键词)
+
+  表达式需与 idx_image_search 完全一致（配置名必须是字面量）才会走 GIN 索引，
+  tortoise 自带的 title__search 不带配置名，用不上索引
+
+  :param keyword: 关键词
+  """
+
+  def __init__(self, keyword: str):
+    super().__init__()
+    self.keyword = keyword
+
+  def resolve(self, resolve_context: ResolveContext) -> QueryModifier:
+    config = LiteralValue("'simple'")
+    vector = Function("TO_TSVECTOR", config, resolve_context.table.title)
+    query = Function("PLAINTO_TSQUERY", config, ValueWrapper(self.keyword))
+    return QueryModifier(where_criterion=BasicCriterion(Comp.search, vector, query))
+
+
+class ImageFilter(TypedDict, total=False):
+  tags: Optional[list[str]]  # 必须同时包含的标签
+  x_restrict: Optional[int]
+  ai_type: Optional[int]
+  created_after: Optional[datetime]
+  created_before: Optional[datetime]
+  updated_after: Optional[datetime]
+  user_id: Optional[str]
+  keyword: Optional[str]  # 标题关键词，postgres 为全文检索（按词匹配），sqlite 为子串匹配
+
+
+def filter_images(filters: Optional[ImageFilter] = None) -> QuerySet[Image]:
+  """根据过滤条件构造查询，值为 None 的条件会被忽略"""
+  query = Image.all()
+  filters = filters or {}
+  if filters.get("tags"):
+    query = filter_tags(query, filters["tags"])
+  if filters.get("x_restrict") is not None:
+    query = query.filter(x_restrict=filters["x_restrict"])
+  if filters.get("ai_type") is not None:
+    query = query.filter(ai_type=filters["ai_type"])
+  if filters.get("created_after"):
+    query = query.filter(created__gte=filters["created_after"])
+  if filters.get("created_before"):
+    query = query.filter(created__lt=filters["created_before"])
+  if filters.get("updated_after"):
+    query = query.filter(updated__gt=filters["updated_after"])
+  if filters.get("user_id"):
+    query = query.filter(user_id=filters["user_id"])
+  if filters.get("keyword"):
+    if is_sqlite():
+      query = query.filter(title__icontains=filters["keyword"])
+    else:
+      query = query.filter(TitleSearch(filters["keyword"]))
+  return query
+
+
 class ImageDB:
   def __init__(self):
     self.db = None
 
-  async def connect(self):
-    await Tortoise.init(db_url=DATABASE_URL, modules={"models": ["models.db"]})
+  async def connect(self, db_url: Optional[str] = None, read_only: bool = False):
+    """
+    连接数据库，并建表 / 迁移字段 / 建索引 / 回填计数
+
+    :param db_url: 数据库连接串，默认 DATABASE_URL
+    :param read_only: 只连接，不执行任何 DDL 和回填（查询服务用，库结构由写入端维护）
+    """
+    db_url = db_url or DATABASE_URL or ""
+    await Tortoise.init(db_url=db_url, modules={"models": model_modules(db_url)})
+    if is_sqlite():
+      await Image._meta.db.execute_script(SQLITE_PRAGMAS)
+    if read_only:
+      return
     await Tortoise.generate_schemas()
+    await migrate_columns()
     await create_custom_indexes()
+    await counters.ensure_initialized()
+
+  async def close(self) -> None:
+    """关闭数据库连接；sqlite 的连接在后台线程中，不关闭进程不会退出"""
+    await Tortoise.close_connections()
 
   async def get_all_unique_tags(self) -> list[str]:
-    query = """
-    SELECT DISTINCT jsonb_array_elements_text(tags) AS tag
-    FROM image
-    """
-    rows = await Image._meta.db.execute_query_dict(query)
-    return [row["tag"] for row in rows]
+    return await counters.get_all_tags()
 
   async def get_images_by_tag(self, tag: str, page: int = 1, page_size: int = 20) -> list[Image]:
     offset = (page - 1) * page_size
-    return await Image.filter(tags__contains=[tag]).offset(offset).limit(page_size).order_by("-created")
+    return await filter_tags(Image.all(), [tag]).offset(offset).limit(page_size).order_by("-created")
 
   async def get_image_count(self) -> int:
-    return await Image.all().count()
+    return await counters.get_total()
 
   async def count_images_by_tag(self, tag: str) -> int:
-    return await Image.filter(tags__contains=[tag]).count()
+    return await counters.get_tag_count(tag)
+
+  async def get_stats(self) -> dict[str, Any]:
+    """总数 / 估算画师数等仪表盘统计"""
+    return await counters.dashboard_stats()
 
   async def get_top_tags(self, limit: int = 30) -> list[tuple[str, int]]:
     """
-    获取最热tags
+    获取最热tags（读取增量维护的 tag_count 表）
     :param limit: 限制返回数量
 
     [('ブルーアーカイブ', 26904), ('アロナ(ブルーアーカイブ)', 23511),...]
     """
-    query = f"""
-      SELECT tag, COUNT(*) as freq
-      FROM (
-        SELECT jsonb_array_elements_text(tags) AS tag
-        FROM image
-      ) AS all_tags
-      GROUP BY tag
-      ORDER BY freq DESC
-      LIMIT {limit}
-      """
-    rows = await Image._meta.db.execute_query_dict(query)
-    return [(row["tag"], row["freq"]) for row in rows]
+    return await counters.get_top_tags(limit)
 
   async def get_recent_images(self, limit: int = 20) -> list[Image]:
     return await Image.all().order_by("-created").limit(limit)
 
+  async def get_images_keyset(
+    self,
+    filters: Optional[ImageFilter] = None,
+    cursor: Optional[tuple[datetime, int]] = None,
+    limit: int = 20,
+    columns: Iterable[str] = (),
+  ) -> list[dict[str, Any]]:
+    """
+    按 (created, id) 倒序的游标分页，深翻页也不需要 OFFSET
+
+    :param filters: 过滤条件
+    :param cursor: 上一页最后一行的 (created, id)
+    :param limit: 每页数量
+    :param columns: 返回的列，为空时返回全部
+    """
+    query = filter_images(filters)
+    if cursor:
+      created, last_id = cursor
+      query = query.filter(Q(created__lt=created) | Q(created=created, id__lt=last_id))
+    return await query.order_by("-created", "-id").limit(limit).values(*columns)
+
+  async def get_existing_img_ids(self, img_ids: list[str]) -> set[str]:
+    """返回已入库的作品 ID"""
+    if not img_ids:
+      return set()
+    rows = await Image.filter(img_id__in=img_ids).distinct().values_list("img_id", flat=True)
+    return set(rows)
+
+  async def iter_phashes(self, batch_size: int = 10000) -> AsyncIterator[tuple[int, str]]:
+    """按主键分批遍历已计算的感知哈希 (id, phash)"""
+    last_id = 0
+    while True:
+      rows = (
+        await Image.filter(id__gt=last_id).exclude(phash="").order_by("id").limit(batch_size).values_list("id", "phash")
+      )
+      if not rows:
+        return
+      for row in rows:
+        yield row
+      last_id = rows[-1][0]
+
+  async def iter_image_rows(
+    self,
+    columns: Iterable[str],
+    filters: Optional[ImageFilter] = None,
+    batch_size: int = 5000,
+  ) -> AsyncIterator[list[dict[str, Any]]]:
+    """
+    按主键分批流式读取图片行（字典，不构造模型对象）
+
+    :param columns: 需要的列
+    :param filters: 过滤条件
+    :param batch_size: 每批行数
+    """
+    columns = list(columns)
+    fields = list(dict.fromkeys(["id", *columns]))
+    drop_id = "id" not in columns
+    query = filter_images(filters)
+    last_id = 0
+    while True:
+      rows = await query.filter(id__gt=last_id).order_by("id").limit(batch_size).values(*fields)
+      if not rows:
+        return
+      last_id = rows[-1]["id"]
+      if drop_id:
+        for row in rows:
+          del row["id"]
+      yield rows
+
+  async def get_stale_img_ids(
+    self,
+    stale_before: datetime,
+    limit: int,
+    created_after: Optional[datetime] = None,
+    min_bookmarks: Optional[int] = None,
+    unrefreshed: bool = False,
+    max_failures: Optional[int] = None,
+  ) -> list[str]:
+    """
+    获取统计数据过期的作品 ID（按上次更新时间从旧到新）
+
+    :param stale_before: updated 早于该时间视为过期
+    :param limit: 返回数量
+    :param created_after: 只选发布时间晚于该时间的作品
+    :param min_bookmarks: 只选收藏数不低于该值的作品
+    :param unrefreshed: 只选从未刷新过统计的作品
+    :param max_failures: 跳过连续刷新失败达到该次数的作品
+    """
+    query = Image.filter(page=0, updated__lt=stale_before)
+    if max_failures is not None:
+      query = query.filter(refresh_failures__lt=max_failures)
+    if created_after:
+      query = query.filter(created__gte=created_after)
+    if min_bookmarks is not None:
+      query = query.filter(bookmarks__gte=min_bookmarks)
+    if unrefreshed:
+      query = query.filter(stats_refreshed_at__isnull=True)
+    return await query.order_by("updated").limit(limit).values_list("img_id", flat=True)
+
+  async def update_stats(self, stats: list[tuple[str, int, int]]) -> None:
+    """
+    批量回写作品统计，一条 UPDATE ... FROM (VALUES ...) 更新所有分页
+
+    :param stats: [(img_id, bookmarks, views)]
+    """
+    if not stats:
+      return
+    rows, values = [], []
+    for img_id, bookmarks, views in stats:
+      a, b, c = sql_params(3, len(values) + 1)
+      rows.append(f"({a}, CAST({b} AS INTEGER), CAST({c} AS INTEGER))")
+      values.extend([img_id, bookmarks, views])
+    # sqlite 的 ? 占位符不能复用，时间戳按两个参数绑定
+    now = datetime.now(timezone.utc)
+    updated, refreshed = sql_params(2, len(values) + 1)
+    values.extend([now, now])
+    # CTE + UPDATE ... FROM 在 postgres 与 sqlite (>= 3.33) 上都可用
+    query = f"""
+      WITH v (img_id, bookmarks, views) AS (VALUES {", ".join(rows)})
+      UPDATE image
+      SET bookmarks = v.bookmarks, views = v.views, refresh_failures = 0,
+          updated = {updated}, stats_refreshed_at = {refreshed}
+      FROM v
+      WHERE image.img_id = v.img_id
+      """
+    await Image._meta.db.execute_query(query, values)
+
+  async def mark_refresh_failed(self, img_ids: list[str]) -> None:
+    """
+    记录刷新失败：失败次数加一并更新 updated，让这些作品排到层级末尾，不再占住每轮的批次
+
+    :param img_ids: 刷新失败的作品 ID
+    """
+    if not img_ids:
+      return
+    now = datetime.now(timezone.utc)
+    await Image.filter(img_id__in=img_ids).update(
+      refresh_failures=F("refresh_failures") + 1, updated=now, stats_refreshed_at=now
+    )
+
   async def get_images_by_user(self, user_id: str, page: int = 1, page_size: int = 20) -> list[Image]:
     offset = (page - 1) * page_size
     return await Image.filter(user_id=user_id).order_by("-created").offset(offset).limit(page_size)
@@ -0,0 +1,127 @@
+from array import array
+from itertools import combinations
+from typing import Iterable, Optional
+
+from db import ImageDB
+
+HASH_BITS = 64
+CHUNK_COUNT = 4
+CHUNK_BITS = HASH_BITS // CHUNK_COUNT
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+def _split(value: int) -> list[int]:
+  return [(value >> (i * CHUNK_BITS)) & CHUNK_MASK for i in range(CHUNK_COUNT)]
+
+
+def _neighbors(chunk: int, radius: int) -> Iterable[int]:
+  """枚举与 chunk 汉明距离不超过 radius 的所有值"""
+  yield chunk
+  for r in range(1, radius + 1):
+    for bits in combinations(range(CHUNK_BITS), r):
+      flipped = chunk
+      for b in bits:
+        flipped ^= 1 << b
+      yield flipped
+
+
+class PHashIndex:
+  """
+  64 位感知哈希的近似重复索引（multi-index hashing）
+
+  哈希切成 4 段 16 位，每段建一张倒排表。两个哈希距离 <= k 时，
+  至少有一段的距离 <= k // 4，因此只需在每张表里探测少量邻近值再逐个校验
+
+  哈希和主键存放在连续的 array 中，倒排表只保存位置下标
+  """
+
+  def __init__(self):
+    self.hashes = array("Q")
+    self.ids = array("q")
+    self._tables: list[dict[int, array]] = [{} for _ in range(CHUNK_COUNT)]
+
+  def __len__(self) -> int:
+    return len(self.hashes)
+
+  def add(self, pk: int, phash: int) -> None:
+    pos = len(self.hashes)
+    self.hashes.append(phash)
+    self.ids.append(pk)
+    for table, chunk in zip(self._tables, _split(phash)):
+      bucket = table.get(chunk)
+      if bucket is None:
+        bucket = table[chunk] = array("I")
+      bucket.append(pos)
+
+  def add_many(self, items: Iterable[tuple[int, int]]) -> None:
+    for pk, phash in items:
+      self.add(pk, phash)
+
+  def _candidates(self, phash: int, k: int) -> set[int]:
+    radius = k // CHUNK_COUNT
+    found: set[int] = set()
+    for table, chunk in zip(self._tables, _split(phash)):
+      for probe in _neighbors(chunk, radius):
+        bucket = table.get(probe)
+        if bucket is not None:
+          found.update(bucket)
+    return found
+
+  def query(self, phash: int, k: int = 6) -> list[tuple[int, int]]:
+    """
+    查找汉明距离 <= k 的所有图片
+
+    :param phash: 64 位感知哈希
+    :param k: 最大汉明距离
+    :return: [(Image 主键, 距离)]，按距离升序
+    """
+    hashes, ids = self.hashes, self.ids
+    result = []
+    for pos in self._candidates(phash, k):
+      dist = (hashes[pos] ^ phash).bit_count()
+      if dist <= k:
+        result.append((ids[pos], dist))
+    result.sort(key=lambda x: x[1])
+    return result
+
+  def contains_near(self, phash: int, k: int = 6) -> bool:
+    """是否存在距离 <= k 的图片，可用于下载前跳过疑似重复"""
+    hashes = self.hashes
+    return any((hashes[pos] ^ phash).bit_count() <= k for pos in self._candidates(phash, k))
+
+  def cluster(self, k: int = 6, min_size: int = 2) -> list[list[int]]:
+    """
+    把距离 <= k 的图片聚成簇（并查集，传递闭包）
+
+    :param k: 最大汉明距离
+    :param min_size: 只返回不少于该数量的簇
+    :return: [[Image 主键, ...]]
+    """
+    parent = list(range(len(self.hashes)))
+
+    def find(x: int) -> int:
+      while parent[x] != x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+      return x
+
+    hashes = self.hashes
+    for pos, phash in enumerate(hashes):
+      for other in self._candidates(phash, k):
+        if other > pos and (hashes[other] ^ phash).bit_count() <= k:
+          a, b = find(pos), find(other)
+          if a != b:
+            parent[b] = a
+
+    groups: dict[int, list[int]] = {}
+    for pos in range(len(hashes)):
+      groups.setdefault(find(pos), []).append(self.ids[pos])
+    return [group for group in groups.values() if len(group) >= min_size]
+
+
+async def build_index(db: ImageDB, index: Optional[PHashIndex] = None) -> PHashIndex:
+  """从数据库加载所有已计算的感知哈希"""
+  index = index or PHashIndex()
+  async for pk, phash in db.iter_phashes():
+    index.add(pk, int(phash, 16))
+  return index
@@ -1,12 +1,18 @@
 import asyncio
 from pathlib import Path
-from typing import TypedDict, Unpack
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypedDict, Unpack
 
 from api import PixivAPIParser
+from metrics import QUEUE_DEPTH, RETRIES, span
+from models.api import Illust, SearchArtWorkResult
 from models.api_query import SearchParamsDict
+from utils import MemoryGuard, rss_bytes
 
 SAVE_DIR = Path("downloads")
 MAX_CONCURRENT = 5
+SEARCH_PAGE_LIMIT = 1000  # 搜索结果最多翻到的页数
+PAUSE_EVERY_PAGES = 90  # 每隔多少页暂停一次，防止封 IP
+PAUSE_SECONDS = 30
 
 
 class TaskItem(TypedDict):
@@ -15,8 +21,24 @@ class TaskItem(TypedDict):
 
 
 class PixivDownloader:
-  def __init__(self, token: str, proxy: str | None = None):
+  def __init__(
+    self,
+    token: str = "",
+    proxy: str | None = None,
+    parser: PixivAPIParser | None = None,
+    meta_concurrency: int = MAX_CONCURRENT,
+  ):
+    """
+    :param token: PHPSESSID
+    :param proxy: 代理地址
+    :param parser: 自定义解析器（例如 session.RotatingAPIParser），传入时忽略 token / proxy
+    :param meta_concurrency: 同时进行的 meta 请求上限，所有 fetch_metas 调用共享
+    """
     self.save_dir = SAVE_DIR
+    self._meta_limit = asyncio.Semaphore(meta_concurrency)
+    if parser is not None:
+      self.parser = parser
+      return
     self.parser = PixivAPIParser()
     self.parser.set_token(token)
     if proxy:
@@ -30,13 +52,39 @@ class PixivDownloader:
     await self.parser.__aexit__(exc_type, exc_val, exc_tb)
 
   async def download_user_illusts(self, user_id: int):
-    """下载用户作品"""
+    """下载用户作品（单页关注列表，完整遍历见 crawler.FollowCrawler）"""
     try:
       result = await self.parser.search_following(user_id)
       return result
     except Exception as e:
       print(f"下载失败: {e}")
 
+  async def fetch_metas(self, illusts: list[Illust], strict: bool = True) -> list[Illust]:
+    """并发补全作品的分页 meta（并发数受 meta_concurrency 限制，多个调用方同时调用也不会超出）
+
+    :param illusts: 作品列表（原地写入 meta）
+    :param strict: 为 True 时任一作品失败即抛出异常，否则跳过失败的作品
+    :return: 成功获取 meta 的作品
+    """
+
+    async def fetch_meta(illust: Illust):
+      async with self._meta_limit:
+        QUEUE_DEPTH.inc(queue="meta")
+        try:
+          meta = await self.parser.search_illust(illust.id)
+          illust.meta = meta.metas
+        except Exception as e:
+          print(f"获取插画 {illust.id} 的 meta 失败: {e}")
+
+          illust.meta = []
+          if strict:
+            raise RuntimeError("获取插画 meta 失败") from e
+        finally:
+          QUEUE_DEPTH.dec(queue="meta")
+
+    await asyncio.gather(*(fetch_meta(illust) for illust in illusts))
+    return [illust for illust in illusts if illust.meta]
+
   async def download_by_tag(self, **kwargs: Unpack[SearchParamsDict]):
     """按标签下载作品
 
@@ -56,21 +104,144 @@ class PixivDownloader:
     :param lang: 返回语言
     """
     try:
-      illusts = await self.parser.search_keyword(**kwargs)
+      with span("search_keyword"):
+        illusts = await self.parser.search_keyword(**kwargs)
 
-      async def fetch_meta(illust):
-        try:
-          meta = await self.parser.search_illust(illust.id)
-          illust.meta = meta.metas
-        except Exception as e:
-          print(f"获取插画 {illust.id} 的 meta 失败: {e}")
-
-          illust.meta = []
-          raise RuntimeError("获取插画 meta 失败") from e
-
-      await asyncio.gather(*(fetch_meta(illust) for illust in illusts.Illusts))
+      with span("fetch_meta"):
+        await self.fetch_metas(illusts.Illusts)
       return illusts.Illusts, illusts.lastPage, illusts.total
 
     except Exception as e:
       print(f"下载失败: {e}")
       return [], 0, 0
+
+  async def search_page(
+    self, retries: int, retry_delay: float, **kwargs: Unpack[SearchParamsDict]
+  ) -> Optional[SearchArtWorkResult]:
+    """获取一页搜索结果，空结果或出错时重试，全部失败返回 None"""
+    for attempt in range(1, retries + 1):
+      try:
+        with span("search_keyword"):
+          result = await self.parser.search_keyword(**kwargs)
+        if result.Illusts:
+          return result
+      except Exception as e:
+        print(f"❌ 第 {kwargs.get('p', 1)} 页请求出错：{e}")
+
+      RETRIES.inc(stage="page")
+      print(f"🔁 第 {kwargs.get('p', 1)} 页重试 {attempt}/{retries} 次…")
+      await asyncio.sleep(retry_delay)
+    return None
+
+  async def iter_by_tag(
+    self,
+    end_page: Optional[int] = None,
+    queue_size: int = 120,
+    meta_concurrency: int = MAX_CONCURRENT,
+    meta_retries: int = 3,
+    guard: Optional[MemoryGuard] = None,
+    page_retries: int = 10,
+    retry_delay: float = 20,
+    pause_every: int = PAUSE_EVERY_PAGES,
+    stored_count: Optional[Callable[[], Awaitable[int]]] = None,
+    **kwargs: Unpack[SearchParamsDict],
+  ) -> AsyncIterator[Illust]:
+    """按标签逐个产出已补全 meta 的作品（流式，带背压）
+
+    搜索翻页 -> 补全 meta -> 调用方之间用有界队列连接：调用方（通常是 batch_create_images）
+    消费变慢时队列写满，上游随之阻塞；RSS 超过 guard 的上限时暂停翻页。
+    内存中最多同时保留 2 * queue_size + meta_concurrency 个作品
+
+    :param end_page: 最后一页，默认到搜索结果末页
+    :param queue_size: 每个阶段之间的队列容量
+    :param meta_concurrency: 补全 meta 的 worker 数（实际并发还受构造参数 meta_concurrency 限制）
+    :param meta_retries: 单个作品 meta 的重试次数，仍失败则跳过
+    :param guard: 内存上限
+    :param page_retries: 单页搜索的重试次数
+    :param retry_delay: 重试间隔（秒）
+    :param pause_every: 每隔多少页暂停 PAUSE_SECONDS 秒，0 表示不暂停
+    :param stored_count: 返回库内图片数的函数（例如 db.get_image_count），提供时每页进度带上库内数量
+    :param kwargs: 搜索参数，同 download_by_tag，p 为起始页
+    """
+    start_page = kwargs.pop("p", 1)
+    illust_q: asyncio.Queue[Optional[Illust]] = asyncio.Queue(queue_size)
+    out_q: asyncio.Queue[Optional[Illust]] = asyncio.Queue(queue_size)
+
+    def drained() -> bool:
+      return illust_q.empty() and out_q.empty()
+
+    async def paginate():
+      page = start_page
+      result = await self.search_page(page_retries, retry_delay, p=page, **kwargs)
+      if result is None:
+        print(f"⚠️ 第 {page} 页数据获取失败")
+        return
+      if end_page is None and result.lastPage >= SEARCH_PAGE_LIMIT:
+        # 结果被截断，只有调用方指定了末页时才接受部分结果
+        print(f"🚨 爬取失败，超过 {SEARCH_PAGE_LIMIT} 页限制")
+        return
+      last_page = min(end_page or result.lastPage, result.lastPage)
+      print(f" {kwargs.get('keyword')}📥 {result.lastPage} 页，共 {result.total} 张插画")
+
+      while True:
+        rss = rss_bytes()
+        notes = [f"库内 {await stored_count()} 张"] if stored_count else []
+        if rss:
+          notes.append(f"内存 {rss >> 20} MiB")
+        print(f"📥 第 {page}/{last_page} 页" + (f"（{'，'.join(notes)}）" if notes else ""))
+        for illust in result.Illusts:
+          await illust_q.put(illust)
+          QUEUE_DEPTH.set(illust_q.qsize(), queue="ingest_meta")
+
+        if page >= last_page:
+          return
+        if pause_every and page % pause_every == 0 and last_page - page > 50:
+          print(f"⏸️ 每 {pause_every} 页暂停 {PAUSE_SECONDS} 秒，防止封 IP")
+          await asyncio.sleep(PAUSE_SECONDS)
+        if guard:
+          await guard.wait(drained)
+
+        page += 1
+        result = await self.search_page(page_retries, retry_delay, p=page, **kwargs)
+        while result is None and page < last_page:
+          print(f"⚠️ 第 {page} 页数据获取失败，跳过")
+          page += 1
+          result = await self.search_page(page_retries, retry_delay, p=page, **kwargs)
+        if result is None:
+          return
+
+    async def produce():
+      try:
+        await paginate()
+      except Exception as e:
+        print(f"❌ 翻页出错：{e}")
+      # 正常结束与出错都要通知下游，否则消费方会一直等待（被取消时不需要）
+      for _ in range(meta_concurrency):
+        await illust_q.put(None)
+
+    async def fetch():
+      while (illust := await illust_q.get()) is not None:
+        QUEUE_DEPTH.set(illust_q.qsize(), queue="ingest_meta")
+        for _ in range(meta_retries):
+          if await self.fetch_metas([illust], strict=False):
+            await out_q.put(illust)
+            QUEUE_DEPTH.set(out_q.qsize(), queue="ingest_write")
+            break
+          RETRIES.inc(stage="meta")
+      await out_q.put(None)
+
+    tasks = [asyncio.create_task(produce()), *(asyncio.create_task(fetch()) for _ in range(meta_concurrency))]
+    finished = 0
+    try:
+      while finished < meta_concurrency:
+        illust = await out_q.get()
+        if illust is None:
+          finished += 1
+          continue
+        QUEUE_DEPTH.set(out_q.qsize(), queue="ingest_write")
+        yield illust
+      await asyncio.gather(*tasks)
+    finally:
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
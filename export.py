@@ -0,0 +1,204 @@
+import argparse
+import asyncio
+import gzip
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Optional
+
+from db import ImageDB, ImageFilter
+
+EXPORT_COLUMNS = (
+  "id",
+  "img_id",
+  "page",
+  "page_count",
+  "title",
+  "description",
+  "tags",
+  "url",
+  "urls",
+  "user_id",
+  "user_name",
+  "width",
+  "height",
+  "bookmarks",
+  "views",
+  "x_restrict",
+  "ai_type",
+  "created",
+  "updated",
+  "size_kb",
+  "file_ext",
+  "hash",
+  "phash",
+  "score",
+)
+JSON_COLUMNS = ("urls", "meta")  # parquet 中以 JSON 字符串保存
+
+
+class ExportError(Exception):
+  """导出异常"""
+
+  pass
+
+
+def _jsonable(value: Any) -> Any:
+  if isinstance(value, datetime):
+    return value.isoformat()
+  return value
+
+
+class JSONLWriter:
+  """gzip 压缩的 JSON Lines"""
+
+  def __init__(self, path: Path):
+    self.path = path
+    self._file = gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+
+  def write(self, rows: list[dict[str, Any]]) -> None:
+    self._file.writelines(
+      json.dumps({k: _jsonable(v) for k, v in row.items()}, ensure_ascii=False) + "\n" for row in rows
+    )
+
+  def close(self) -> None:
+    self._file.close()
+
+
+class ParquetWriter:
+  """按批写入 parquet row group，内存只保留当前批"""
+
+  def __init__(self, path: Path, columns: tuple[str, ...]):
+    try:
+      import pyarrow as pa
+      import pyarrow.parquet as pq
+    except ImportError as e:
+      raise ExportError("导出 parquet 需要安装 pyarrow: uv add pyarrow") from e
+
+    self._pa = pa
+    types = {
+      "id": pa.int64(),
+      "page": pa.int32(),
+      "page_count": pa.int32(),
+      "tags": pa.list_(pa.string()),
+      "width": pa.int32(),
+      "height": pa.int32(),
+      "bookmarks": pa.int32(),
+      "views": pa.int32(),
+      "x_restrict": pa.int8(),
+      "ai_type": pa.int8(),
+      "created": pa.timestamp("us", tz="UTC"),
+      "updated": pa.timestamp("us", tz="UTC"),
+      "size_kb": pa.int32(),
+      "score": pa.int32(),
+    }
+    self.schema = pa.schema([(c, types.get(c, pa.string())) for c in columns])
+    self._writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+  def write(self, rows: list[dict[str, Any]]) -> None:
+    for row in rows:
+      for key in JSON_COLUMNS:
+        if key in row:
+          row[key] = json.dumps(row[key], ensure_ascii=False)
+    self._writer.write_table(self._pa.Table.from_pylist(rows, schema=self.schema))
+
+  def close(self) -> None:
+    self._writer.close()
+
+
+def _load_state(path: Path) -> Optional[datetime]:
+  if not path.exists():
+    return None
+  data = json.loads(path.read_text(encoding="utf-8"))
+  return datetime.fromisoformat(data["since"])
+
+
+def _save_state(path: Path, since: datetime) -> None:
+  path.write_text(json.dumps({"since": since.isoformat()}), encoding="utf-8")
+
+
+def delta_path(out_path: Path, started: datetime) -> Path:
+  """增量导出每次写入新文件: images.jsonl.gz -> images.20250101T000000Z.jsonl.gz"""
+  name = out_path.name
+  stem, dot, suffixes = name.partition(".")
+  return out_path.with_name(f"{stem}.{started:%Y%m%dT%H%M%SZ}{dot}{suffixes}")
+
+
+async def export_images(
+  db: ImageDB,
+  out_path: Path,
+  fmt: str = "jsonl",
+  columns: tuple[str, ...] = EXPORT_COLUMNS,
+  filters: Optional[ImageFilter] = None,
+  state_path: Optional[Path] = None,
+  batch_size: int = 5000,
+) -> tuple[int, Path]:
+  """
+  流式导出图片表
+
+  :param db: 数据库
+  :param out_path: 输出文件；增量导出时每次写入带时间戳的新文件，见 delta_path
+  :param fmt: jsonl（gzip）或 parquet
+  :param columns: 导出的列
+  :param filters: 过滤条件
+  :param state_path: 增量状态文件；存在时只导出上次导出之后新增或更新的行
+  :param batch_size: 每批读取的行数
+  :return: (导出的行数, 实际写入的文件)
+  """
+  filters = dict(filters or {})
+  started = datetime.now(timezone.utc)
+  if state_path:
+    since = _load_state(state_path)
+    if since:
+      filters["updated_after"] = since
+      print(f"📦 增量导出 {since.isoformat()} 之后的数据")
+    # 写入模式会截断文件，每次的增量单独成文件，避免覆盖之前的导出
+    out_path = delta_path(out_path, started)
+
+  writer = ParquetWriter(out_path, columns) if fmt == "parquet" else JSONLWriter(out_path)
+  total = 0
+  try:
+    async for rows in db.iter_image_rows(columns, filters, batch_size):
+      writer.write(rows)
+      total += len(rows)
+  finally:
+    writer.close()
+
+  if state_path:
+    _save_state(state_path, started)
+  return total, out_path
+
+
+async def main():
+  parser = argparse.ArgumentParser(description="导出图片数据")
+  parser.add_argument("output", type=Path)
+  parser.add_argument("--format", choices=("jsonl", "parquet"), default="jsonl")
+  parser.add_argument("--columns", help="逗号分隔的列名")
+  parser.add_argument("--tag", action="append", dest="tags", help="必须包含的标签，可重复")
+  parser.add_argument("--x-restrict", type=int)
+  parser.add_argument("--ai-type", type=int)
+  parser.add_argument("--since", type=datetime.fromisoformat, help="作品发布时间下限")
+  parser.add_argument("--until", type=datetime.fromisoformat, help="作品发布时间上限")
+  parser.add_argument("--state", type=Path, help="增量导出状态文件，指定后每次输出带时间戳的新文件")
+  args = parser.parse_args()
+
+  columns = tuple(args.columns.split(",")) if args.columns else EXPORT_COLUMNS
+  filters: ImageFilter = {
+    "tags": args.tags,
+    "x_restrict": args.x_restrict,
+    "ai_type": args.ai_type,
+    "created_after": args.since,
+    "created_before": args.until,
+  }
+
+  db = ImageDB()
+  await db.connect()
+  try:
+    total, path = await export_images(db, args.output, args.format, columns, filters, args.state)
+    print(f"📦 导出 {total} 行 -> {path}")
+  finally:
+    await db.close()
+
+
+if __name__ == "__main__":
+  asyncio.run(main())
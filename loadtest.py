@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+DEFAULT_PATHS = (
+  "/api/recent",
+  "/api/tags/top",
+  "/api/stats",
+)
+
+
+def percentile(values: list[float], p: float) -> float:
+  if not values:
+    return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run(base_url: str, paths: list[str], concurrency: int, duration: float, etag: bool) -> None:
+  """
+  对查询服务做简单压测
+
+  :param base_url: 服务地址
+  :param paths: 轮流请求的路径
+  :param concurrency: 并发连接数
+  :param duration: 持续时间（秒）
+  :param etag: 是否携带 If-None-Match，模拟浏览器缓存
+  """
+  latencies: list[float] = []
+  statuses: dict[int, int] = {}
+  deadline = time.perf_counter() + duration
+  connector = aiohttp.TCPConnector(limit=concurrency)
+
+  async with aiohttp.ClientSession(base_url, connector=connector) as session:
+
+    async def worker(n: int):
+      etags: dict[str, str] = {}
+      i = n
+      while time.perf_counter() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        headers = {"Accept-Encoding": "gzip"}
+        if etag and path in etags:
+          headers["If-None-Match"] = etags[path]
+        start = time.perf_counter()
+        try:
+          async with session.get(path, headers=headers) as resp:
+            await resp.read()
+            statuses[resp.status] = statuses.get(resp.status, 0) + 1
+            if "ETag" in resp.headers:
+              etags[path] = resp.headers["ETag"]
+        except aiohttp.ClientError:
+          statuses[-1] = statuses.get(-1, 0) + 1
+          continue
+        latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+
+  total = sum(statuses.values())
+  print(f"🚀 {total} 个请求, {total / duration:.0f} req/s")
+  print(f"   状态码: {statuses}")
+  print(
+    f"   延迟 p50={percentile(latencies, 0.5) * 1000:.1f}ms "
+    f"p95={percentile(latencies, 0.95) * 1000:.1f}ms "
+    f"p99={percentile(latencies, 0.99) * 1000:.1f}ms"
+  )
+
+
+def main():
+  parser = argparse.ArgumentParser(description="查询服务压测")
+  parser.add_argument("--url", default="http://127.0.0.1:8080")
+  parser.add_argument("--path", action="append", dest="paths", help="请求路径，可重复")
+  parser.add_argument("-c", "--concurrency", type=int, default=64)
+  parser.add_argument("-d", "--duration", type=float, default=10)
+  parser.add_argument("--etag", action="store_true", help="携带 If-None-Match")
+  args = parser.parse_args()
+  asyncio.run(run(args.url, args.paths or list(DEFAULT_PATHS), args.concurrency, args.duration, args.etag))
+
+
+if __name__ == "__main__":
+  main()
@@ -2,17 +2,51 @@ import asyncio
 import os
 import time
 from datetime import datetime, timedelta
+from pathlib import Path
 
 from dotenv import load_dotenv
 
-from db import ImageDB
+from cache import CachedImageDB
+from crawler import FollowCrawler, UserCrawler
+from dedup import build_index
 from downloader import PixivDownloader
-from utils import batch_create_images
+from export import export_images
+from metrics import TRACER, export_periodically, span
+from models.db import Image
+from postprocess import PostProcessor
+from refresher import StatsRefresher
+from scheduler import DownloadScheduler
+from session import SessionManager
+from utils import MemoryGuard, batch_create_images
 
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 PROXY = os.getenv("PROXY")
+REDIS_URL = os.getenv("REDIS_URL") or None  # 与查询服务共用，入库时失效其 Redis 缓存
 TOKEN = os.getenv("PHPSESSID")
+TOKENS = [t.strip() for t in os.getenv("PHPSESSIDS", "").split(",") if t.strip()] or [TOKEN or ""]  # 多账号轮换
+METRICS_PATH = os.getenv("METRICS_PATH")  # 指标输出文件, .prom 结尾输出 Prometheus 文本, 其余为 JSON 快照
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "30"))
+TRACE = os.getenv("TRACE") == "1"  # 开启阶段追踪
+INGEST_MEMORY_MB = int(os.getenv("INGEST_MEMORY_MB", "0"))  # 爬取时的内存上限（MiB），0 表示不限制
+DOWNLOAD_BANDWIDTH = float(os.getenv("DOWNLOAD_BANDWIDTH", "0")) or None  # 下载带宽上限（字节/秒）
+
+
+async def open_db() -> CachedImageDB:
+  """连接数据库；每批入库后会失效本进程和 Redis 中受影响的缓存"""
+  db = CachedImageDB(redis_url=REDIS_URL)
+  await db.connect()
+  return db
+
+
+async def open_sessions() -> SessionManager | None:
+  """验证所有账号（PHPSESSIDS），没有可用账号时返回 None"""
+  sessions = SessionManager(TOKENS, proxy=PROXY)
+  if not await sessions.validate_all():
+    print("🚨 没有可用的账号，请检查 PHPSESSID")
+    await sessions.close()
+    return None
+  return sessions
 
 
 async def run_scrap():
@@ -49,69 +83,144 @@ async def run_scrap():
   tag = "調月リオ"
   tag = "正義実現委員会のモブ"
 
-  db = ImageDB()
-  await db.connect()
+  db = await open_db()
+  exporter = None
+  try:
+    if METRICS_PATH:
+      fmt = "prometheus" if METRICS_PATH.endswith(".prom") else "json"
+      exporter = asyncio.create_task(export_periodically(Path(METRICS_PATH), METRICS_INTERVAL, fmt))
+    if TRACE:
+      TRACER.enable()
+
+    sessions = await open_sessions()
+    if sessions is None:
+      return
 
-  page = 1
+    # 翻页 -> meta -> 入库 全程流式，写库变慢或内存超过上限时自动暂停翻页
+    guard = MemoryGuard(INGEST_MEMORY_MB << 20 if INGEST_MEMORY_MB else None)
+    async with PixivDownloader(parser=sessions.parser()) as downloader:
+      try:
+        with span("ingest"):
+          await batch_create_images(downloader.iter_by_tag(guard=guard, stored_count=db.get_image_count, keyword=tag))
+      except Exception as e:
+        print(f"❌ {tag} 入库失败：{e}")
 
-  async with PixivDownloader(token=TOKEN or "", proxy=PROXY) as downloader:
-    data, pages, total = await downloader.download_by_tag(
-      keyword=tag,
-      p=page,
-    )
-    if pages == 1000:
-      print("🚨 爬取失败，超过 1000 页限制")
+    print(f"📈 内存峰值 {guard.peak >> 20} MiB，因内存暂停 {guard.pauses} 次")
+
+    c = await db.get_image_count()
+    print("\n", c)
+  finally:
+    # 没有可用账号提前返回或出错时也要停掉指标导出
+    if exporter:
+      exporter.cancel()
+      await asyncio.gather(exporter, return_exceptions=True)
+    await db.close()
+
+
+async def run_follow_crawl(seed_user_id: int, depth: int = 1):
+  db = await open_db()
+  try:
+    sessions = await open_sessions()
+    if sessions is None:
       return
+    async with PixivDownloader(parser=sessions.parser()) as downloader:
+      crawler = FollowCrawler(downloader, max_depth=depth)
+      stats = await crawler.crawl(seed_user_id)
 
-    print(f" {tag}📥 {pages} 页，共 {total} 张插画")
-
-    max_retries = 10
-    retry_delay = 20
-
-    while page <= pages:
-      print(f"📥 第 {page}/{pages} 页")
-      retries = 0
-      while retries < max_retries:
-        try:
-          data, _, _ = await downloader.download_by_tag(
-            keyword=tag,
-            p=page,
-          )
-          if data:
-            break
-        except Exception as e:
-          print(f"❌ 第 {page} 页请求出错：{e}")
-
-        retries += 1
-        print(f"🔁 第 {page} 页重试 {retries}/{max_retries} 次…")
-        await asyncio.sleep(retry_delay)
-
-      if not data:
-        print(f"⚠️ 第 {page} 页数据获取失败，跳过")
-        page += 1
-        continue
+    print(
+      f"🕸️ 展开 {stats.users} 个用户，发现 {stats.discovered} 个画师，入库 {stats.illusts} 个作品，失败 {stats.failed}"
+    )
+  finally:
+    await db.close()
 
-      try:
-        await batch_create_images(data)
-      except Exception as e:
-        print(f"❌ 第 {page} 页入库失败：{e}")
 
-      if page % 90 == 0 and pages - page > 50:
-        print("⏸️ 每 90 页暂停 30 秒，防止封 IP")
-        await asyncio.sleep(30)
+async def run_user_sync(user_id: int):
+  """同步自己关注的所有画师的全部作品"""
+  db = await open_db()
+  try:
+    sessions = await open_sessions()
+    if sessions is None:
+      return
+    async with PixivDownloader(parser=sessions.parser()) as downloader:
+      following = FollowCrawler(downloader)
+      artists = [user.user_id async for user in following.iter_following(user_id)]
+      print(f"👤 共关注 {len(artists)} 个画师")
+
+      stats = await UserCrawler(downloader, db).crawl_many(artists)
+
+    print(f"👤 同步 {stats.users} 个画师，入库 {stats.illusts} 个作品，失败 {stats.failed}")
+  finally:
+    await db.close()
+
+
+async def run_dedupe(k: int = 6):
+  """按感知哈希聚类，输出疑似重复的图片组"""
+  db = await open_db()
+  try:
+    index = await build_index(db)
+    clusters = await asyncio.to_thread(index.cluster, k)
+    dupes = sum(len(c) - 1 for c in clusters)
+    print(f"🧬 {len(index)} 张图片，{len(clusters)} 组疑似重复，可去除 {dupes} 张")
+    return clusters
+  finally:
+    await db.close()
+
+
+async def run_export(output: str = "export/images.jsonl.gz", tag: str | None = None):
+  """增量导出图片数据（完整参数见 export.py 命令行）"""
+  db = await open_db()
+  try:
+    out = Path(output)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    total, path = await export_images(
+      db, out, filters={"tags": [tag] if tag else None}, state_path=out.with_suffix(".state")
+    )
+    print(f"📦 导出 {total} 行 -> {path}")
+  finally:
+    await db.close()
 
-      page += 1
 
-  c = await db.get_image_count()
-  print("\n", c)
+async def run_refresh():
+  """后台持续刷新收藏 / 浏览数"""
+  db = await open_db()
+  try:
+    sessions = await open_sessions()
+    if sessions is None:
+      return
+    async with PixivDownloader(parser=sessions.parser()) as downloader:
+      await StatsRefresher(downloader.parser, db).run_forever()
+  finally:
+    await db.close()
+
+
+async def run_download(tag: str, variant: str = "original"):
+  """按收藏数从高到低下载某个 tag 已入库的图片（动图下载压缩包并合成），原图下载后计算 hash / phash 供去重使用"""
+  db = await open_db()
+  try:
+    sessions = await open_sessions()
+    if sessions is None:
+      return
+    columns = ("id", "img_id", "page", "user_id", "urls", "file_ext", "bookmarks", "meta", "hash")
+    async with PixivDownloader(parser=sessions.parser()) as downloader, PostProcessor() as postprocessor:
+      async with DownloadScheduler(
+        downloader.parser, downloader.save_dir, bandwidth=DOWNLOAD_BANDWIDTH, postprocessor=postprocessor
+      ) as scheduler:
+        async for rows in db.iter_image_rows(columns, {"tags": [tag]}):
+          for row in rows:
+            scheduler.submit(Image(**row), variant)
+        await scheduler.join()
+    print(f"📥 {tag} 下载完成，后处理 {postprocessor.processed} 张，失败 {postprocessor.failed} 张")
+  finally:
+    await db.close()
 
 
 async def query():
-  db = ImageDB()
-  await db.connect()
-
-  c = await db.get_image_count()
-  print("\n", c)
+  db = await open_db()
+  try:
+    stats = await db.get_stats()
+    print(f"\n🔢 图片 {stats['images']} 张，tag {stats['tags']} 个，画师约 {stats['users_approx']} 位")
+  finally:
+    await db.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,365 @@
+import asyncio
+import contextvars
+import json
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelKey = Tuple[str, ...]
+
+
+def _label_key(labelnames: Tuple[str, ...], labels: Dict[str, Any]) -> LabelKey:
+  if set(labels) != set(labelnames):
+    raise ValueError(f"标签不匹配: 需要 {labelnames}, 实际 {tuple(labels)}")
+  return tuple(str(labels[name]) for name in labelnames)
+
+
+def _format_labels(labelnames: Tuple[str, ...], key: LabelKey, extra: str = "") -> str:
+  pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, key)]
+  if extra:
+    pairs.append(extra)
+  return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+  return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+  kind = ""
+
+  def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+    self._lock = threading.Lock()
+
+  def _header(self) -> list[str]:
+    return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+  """单调递增计数器"""
+
+  kind = "counter"
+
+  def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+    super().__init__(name, documentation, labelnames)
+    self._values: Dict[LabelKey, float] = {}
+
+  def inc(self, amount: float = 1, **labels: Any) -> None:
+    if amount < 0:
+      raise ValueError("计数器只能增加")
+    key = _label_key(self.labelnames, labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+  def value(self, **labels: Any) -> float:
+    return self._values.get(_label_key(self.labelnames, labels), 0)
+
+  def collect(self) -> list[str]:
+    lines = self._header()
+    with self._lock:
+      for key, value in sorted(self._values.items()):
+        lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+    return lines
+
+  def snapshot(self) -> list[Dict[str, Any]]:
+    with self._lock:
+      return [{"labels": dict(zip(self.labelnames, key)), "value": v} for key, v in self._values.items()]
+
+
+class Gauge(_Metric):
+  """可增可减的瞬时值，例如队列深度"""
+
+  kind = "gauge"
+
+  def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+    super().__init__(name, documentation, labelnames)
+    self._values: Dict[LabelKey, float] = {}
+
+  def set(self, value: float, **labels: Any) -> None:
+    key = _label_key(self.labelnames, labels)
+    with self._lock:
+      self._values[key] = value
+
+  def inc(self, amount: float = 1, **labels: Any) -> None:
+    key = _label_key(self.labelnames, labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+  def dec(self, amount: float = 1, **labels: Any) -> None:
+    self.inc(-amount, **labels)
+
+  def value(self, **labels: Any) -> float:
+    return self._values.get(_label_key(self.labelnames, labels), 0)
+
+  def collect(self) -> list[str]:
+    lines = self._header()
+    with self._lock:
+      for key, value in sorted(self._values.items()):
+        lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+    return lines
+
+  def snapshot(self) -> list[Dict[str, Any]]:
+    with self._lock:
+      return [{"labels": dict(zip(self.labelnames, key)), "value": v} for key, v in self._values.items()]
+
+
+class Histogram(_Metric):
+  """分桶直方图，用于延迟与大小分布"""
+
+  kind = "histogram"
+
+  def __init__(
+    self,
+    name: str,
+    documentation: str,
+    labelnames: Tuple[str, ...] = (),
+    buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+  ):
+    super().__init__(name, documentation, labelnames)
+    self.buckets = tuple(sorted(buckets))
+    # key -> [每个桶的计数..., +Inf 计数], 总和
+    self._counts: Dict[LabelKey, list[int]] = {}
+    self._sums: Dict[LabelKey, float] = {}
+
+  def observe(self, value: float, **labels: Any) -> None:
+    key = _label_key(self.labelnames, labels)
+    idx = bisect_left(self.buckets, value)
+    with self._lock:
+      counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+      counts[idx] += 1
+      self._sums[key] = self._sums.get(key, 0.0) + value
+
+  @contextmanager
+  def time(self, **labels: Any) -> Iterator[None]:
+    """计时上下文，退出时记录耗时（秒）"""
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - start, **labels)
+
+  def count(self, **labels: Any) -> int:
+    return sum(self._counts.get(_label_key(self.labelnames, labels), []))
+
+  def collect(self) -> list[str]:
+    lines = self._header()
+    with self._lock:
+      for key in sorted(self._counts):
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self._counts[key]):
+          cumulative += n
+          le = "+Inf" if bound == float("inf") else repr(bound)
+          labels = _format_labels(self.labelnames, key, 'le="' + le + '"')
+          lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {self._sums[key]}")
+        lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+    return lines
+
+  def snapshot(self) -> list[Dict[str, Any]]:
+    with self._lock:
+      return [
+        {
+          "labels": dict(zip(self.labelnames, key)),
+          "count": sum(counts),
+          "sum": self._sums[key],
+          "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], counts)),
+        }
+        for key, counts in self._counts.items()
+      ]
+
+
+class Registry:
+  """指标注册表，同名指标只会创建一次"""
+
+  def __init__(self):
+    self._metrics: Dict[str, _Metric] = {}
+    self._lock = threading.Lock()
+
+  def _get_or_create(self, cls, name: str, *args, **kwargs):
+    with self._lock:
+      metric = self._metrics.get(name)
+      if metric is None:
+        metric = cls(name, *args, **kwargs)
+        self._metrics[name] = metric
+      elif not isinstance(metric, cls):
+        raise ValueError(f"指标 {name} 已注册为 {metric.kind}")
+      return metric
+
+  def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+    return self._get_or_create(Counter, name, documentation, labelnames)
+
+  def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+    return self._get_or_create(Gauge, name, documentation, labelnames)
+
+  def histogram(
+    self,
+    name: str,
+    documentation: str,
+    labelnames: Tuple[str, ...] = (),
+    buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+  ) -> Histogram:
+    return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+  def to_prometheus(self) -> str:
+    """导出 Prometheus 文本格式"""
+    lines: list[str] = []
+    for metric in list(self._metrics.values()):
+      lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+  def snapshot(self) -> Dict[str, Any]:
+    """导出 JSON 快照"""
+    return {
+      "timestamp": time.time(),
+      "metrics": {
+        name: {"type": metric.kind, "samples": metric.snapshot()} for name, metric in list(self._metrics.items())
+      },
+    }
+
+
+REGISTRY = Registry()
+
+# 网络
+REQUEST_LATENCY = REGISTRY.histogram("pixiv_request_seconds", "API 请求耗时", ("endpoint",))
+REQUEST_STATUS = REGISTRY.counter("pixiv_requests_total", "API 请求次数（按状态码）", ("endpoint", "status"))
+RETRIES = REGISTRY.counter("pixiv_retries_total", "重试次数", ("stage",))
+DOWNLOAD_BYTES = REGISTRY.counter("pixiv_download_bytes_total", "已下载字节数")
+
+# 数据库
+ROWS_INSERTED = REGISTRY.counter("pixiv_db_rows_inserted_total", "提交入库的图片行数")
+DB_BATCH_LATENCY = REGISTRY.histogram("pixiv_db_batch_seconds", "批量入库耗时")
+
+# 流水线
+QUEUE_DEPTH = REGISTRY.gauge("pixiv_queue_depth", "队列深度 / 进行中的任务数", ("queue",))
+STAGE_LATENCY = REGISTRY.histogram("pixiv_stage_seconds", "各阶段耗时", ("stage",))
+PROCESS_RSS = REGISTRY.gauge("pixiv_process_rss_bytes", "进程常驻内存")
+
+# 查询服务
+SERVER_LATENCY = REGISTRY.histogram("pixiv_server_request_seconds", "查询服务请求耗时", ("route",))
+
+
+_ID_SEGMENT = re.compile(r"^\d+$")
+
+
+def endpoint_label(url: str) -> str:
+  """
+  把请求 URL 归一化为低基数的接口标签
+
+  https://www.pixiv.net/ajax/illust/123/pages -> /ajax/illust/{id}/pages
+  https://www.pixiv.net/ajax/search/artworks/xxx -> /ajax/search/artworks/{keyword}
+  """
+  path = url.split("://", 1)[-1].split("?", 1)[0]
+  segments = path.split("/")[1:]
+  normalized = []
+  for i, segment in enumerate(segments):
+    if _ID_SEGMENT.match(segment):
+      normalized.append("{id}")
+    elif i > 0 and segments[i - 1] == "artworks" and "search" in segments:
+      normalized.append("{keyword}")
+    else:
+      normalized.append(segment)
+  return "/" + "/".join(normalized)
+
+
+# ---------------------------------------------------------------- 阶段耗时 / 追踪
+
+_current_span: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("pixiv_span", default=None)
+
+
+class Tracer:
+  """
+  简易阶段追踪器
+
+  开启后每个 span 会记录到有限长度的环形缓冲区，方便事后导出排查瓶颈
+  :param maxlen: 保留的 span 数量上限
+  """
+
+  def __init__(self, maxlen: int = 10000):
+    self.enabled = False
+    self.spans: deque[Dict[str, Any]] = deque(maxlen=maxlen)
+
+  def enable(self) -> None:
+    self.enabled = True
+
+  def disable(self) -> None:
+    self.enabled = False
+
+  def dump(self) -> list[Dict[str, Any]]:
+    return list(self.spans)
+
+
+TRACER = Tracer()
+
+
+@contextmanager
+def span(stage: str, **attrs: Any) -> Iterator[None]:
+  """
+  记录一个阶段的耗时（同步 / 异步代码均可使用）
+
+  with span("fetch_meta", illust_id=id):
+    ...
+  """
+  parent = _current_span.get()
+  token = _current_span.set(stage)
+  start = time.perf_counter()
+  wall = time.time()
+  try:
+    yield
+  finally:
+    duration = time.perf_counter() - start
+    _current_span.reset(token)
+    STAGE_LATENCY.observe(duration, stage=stage)
+    if TRACER.enabled:
+      TRACER.spans.append({"stage": stage, "parent": parent, "start": wall, "duration": duration, **attrs})
+
+
+# ---------------------------------------------------------------- 导出
+
+
+def write_prometheus(path: Path, registry: Registry = REGISTRY) -> None:
+  """写出 Prometheus 文本（可配合 node_exporter textfile collector）"""
+  tmp = path.with_suffix(path.suffix + ".tmp")
+  tmp.write_text(registry.to_prometheus(), encoding="utf-8")
+  tmp.replace(path)
+
+
+def write_snapshot(path: Path, registry: Registry = REGISTRY) -> None:
+  """追加一行 JSON 快照"""
+  data = registry.snapshot()
+  if TRACER.enabled:
+    data["spans"] = TRACER.dump()
+    TRACER.spans.clear()
+  with open(path, "a", encoding="utf-8") as f:
+    f.write(json.dumps(data, ensure_ascii=False) + "\n")
+
+
+async def export_periodically(
+  path: Path,
+  interval: float = 30,
+  fmt: str = "json",
+  registry: Registry = REGISTRY,
+) -> None:
+  """
+  周期性导出指标，作为后台任务运行
+
+  :param path: 输出文件
+  :param interval: 导出间隔（秒）
+  :param fmt: json（追加快照）或 prometheus（覆盖写文本）
+  """
+  writer = write_snapshot if fmt == "json" else write_prometheus
+  try:
+    while True:
+      await asyncio.sleep(interval)
+      writer(path, registry)
+  finally:
+    writer(path, registry)
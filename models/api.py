@@ -242,3 +242,92 @@ class SearchIllustMetaResult:
       metas=[IllustMeta.from_dict(i) for i in body],
       error=raw_data.get("error", False),
     )
+
+
+@dataclass
+class UserProfileAllResult:
+  illust_ids: List[str]
+  manga_ids: List[str]
+  error: bool
+
+  @classmethod
+  def from_response(cls, raw_data: Dict[str, Any]):
+    body = raw_data.get("body", {})
+    # illusts / manga 为 {id: null} 形式, 没有作品时为空列表
+    illusts = body.get("illusts") or {}
+    manga = body.get("manga") or {}
+    return cls(
+      illust_ids=sorted(illusts, key=int, reverse=True),
+      manga_ids=sorted(manga, key=int, reverse=True),
+      error=raw_data.get("error", False),
+    )
+
+  @property
+  def all_ids(self) -> List[str]:
+    return sorted({*self.illust_ids, *self.manga_ids}, key=int, reverse=True)
+
+
+@dataclass
+class UserWorksResult:
+  Illusts: List[Illust]
+  error: bool
+
+  @classmethod
+  def from_response(cls, raw_data: Dict[str, Any]):
+    body = raw_data.get("body", {})
+    works = body.get("works") or {}
+    return cls(
+      Illusts=[Illust.from_dict(i) for i in works.values()],
+      error=raw_data.get("error", False),
+    )
+
+
+@dataclass
+class UgoiraFrame:
+  file: str  # 压缩包内的文件名，如 000000.jpg
+  delay: int  # 帧延迟（毫秒）
+
+
+@dataclass
+class UgoiraMeta:
+  src: str  # 600x600 压缩包
+  original_src: str  # 原尺寸压缩包
+  mime_type: str
+  frames: List[UgoiraFrame]
+  error: bool
+
+  @classmethod
+  def from_response(cls, raw_data: Dict[str, Any]):
+    body = raw_data.get("body", {})
+    return cls(
+      src=body.get("src", ""),
+      original_src=body.get("originalSrc", ""),
+      mime_type=body.get("mime_type", ""),
+      frames=[UgoiraFrame(file=f.get("file", ""), delay=f.get("delay", 0)) for f in body.get("frames", [])],
+      error=raw_data.get("error", False),
+    )
+
+  def to_dict(self) -> Dict[str, Any]:
+    return {"mime_type": self.mime_type, "frames": [asdict(f) for f in self.frames]}
+
+
+@dataclass
+class IllustStats:
+  id: str
+  bookmark_count: int  # 公开收藏数
+  like_count: int
+  view_count: int
+  comment_count: int
+  error: bool
+
+  @classmethod
+  def from_response(cls, raw_data: Dict[str, Any]):
+    body = raw_data.get("body", {})
+    return cls(
+      id=str(body.get("illustId", body.get("id", ""))),
+      bookmark_count=body.get("bookmarkCount", 0),
+      like_count=body.get("likeCount", 0),
+      view_count=body.get("viewCount", 0),
+      comment_count=body.get("commentCount", 0),
+      error=raw_data.get("error", False),
+    )
@@ -8,6 +8,7 @@ class Image(Model):
   id = fields.BigIntField(pk=True)  # 自增主键
   img_id = fields.CharField(max_length=255)  # 平台ID如129557899
   hash = fields.CharField(max_length=64)  # SHA-256哈希
+  phash = fields.CharField(max_length=16, default="")  # 感知哈希(64位, 十六进制)
 
   # 内容元数据
   title = fields.CharField(max_length=255)  # 完整标题
@@ -29,6 +30,8 @@ class Image(Model):
   height = fields.IntField()
   bookmarks = fields.IntField(index=True)  # 收藏数
   views = fields.IntField(null=True)  # 浏览数
+  refresh_failures = fields.IntField(default=0)  # 统计刷新连续失败次数（作品已删除 / 转为私密）
+  stats_refreshed_at = fields.DatetimeField(null=True)  # 最近一次尝试刷新统计的时间，入库后从未刷新过为空
 
   # 内容属性
   source = fields.CharField(max_length=20)  # pixiv/twitter
@@ -60,3 +63,23 @@ class Image(Model):
       ),
     ]
     unique_together = (("img_id", "page"),)
+
+
+class TagCount(Model):
+  """每个 tag 的图片数（按页计），入库时增量维护"""
+
+  tag = fields.CharField(max_length=255, pk=True)
+  count = fields.BigIntField(default=0, index=True)
+
+  class Meta:
+    table = "tag_count"
+
+
+class Counter(Model):
+  """全局计数，例如图片总数"""
+
+  name = fields.CharField(max_length=64, pk=True)
+  value = fields.BigIntField(default=0)
+
+  class Meta:
+    table = "counter"
@@ -0,0 +1,17 @@
+from tortoise import fields
+from tortoise.models import Model
+
+
+class ImageTag(Model):
+  """
+  sqlite 模式下的 tag 倒排表，由 image 表上的触发器维护
+
+  postgres 直接对 jsonb 建 GIN 索引，不需要这张表
+  """
+
+  image_id = fields.BigIntField()
+  tag = fields.CharField(max_length=255)
+
+  class Meta:
+    table = "image_tag"
+    unique_together = (("tag", "image_id"),)
@@ -0,0 +1,205 @@
+import asyncio
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from tortoise.transactions import in_transaction
+
+from metrics import DB_BATCH_LATENCY, QUEUE_DEPTH, STAGE_LATENCY
+from models.db import Image
+from utils import sha256_from_bytes
+
+THUMB_SIZE = 256
+PHASH_SIZE = 32  # DCT 输入边长
+PHASH_BITS = 8  # 取左上角 8x8 低频系数 => 64 位
+
+# DCT-II 余弦表，只需要前 PHASH_BITS 个频率
+_DCT_TABLE = [
+  [math.cos(math.pi * (2 * x + 1) * u / (2 * PHASH_SIZE)) for x in range(PHASH_SIZE)] for u in range(PHASH_BITS)
+]
+
+
+def phash_pixels(pixels: list[int]) -> int:
+  """
+  对 32x32 灰度像素计算 64 位感知哈希
+
+  :param pixels: 行优先排列的 PHASH_SIZE * PHASH_SIZE 个灰度值
+  """
+  n = PHASH_SIZE
+  rows = [pixels[i * n : (i + 1) * n] for i in range(n)]
+  # 先对每行做一维 DCT，再对列做
+  row_dct = [[sum(c * p for c, p in zip(_DCT_TABLE[u], row)) for u in range(PHASH_BITS)] for row in rows]
+  coeffs = [
+    sum(_DCT_TABLE[v][y] * row_dct[y][u] for y in range(n)) for v in range(PHASH_BITS) for u in range(PHASH_BITS)
+  ]
+  # 跳过直流分量计算中位数
+  ac = sorted(coeffs[1:])
+  median = (ac[len(ac) // 2 - 1] + ac[len(ac) // 2]) / 2
+  value = 0
+  for c in coeffs:
+    value = (value << 1) | (c > median)
+  return value
+
+
+def phash_to_hex(value: int) -> str:
+  return f"{value:016x}"
+
+
+def hamming(a: int, b: int) -> int:
+  return (a ^ b).bit_count()
+
+
+@dataclass
+class ProcessResult:
+  pk: int
+  hash: str
+  size_kb: int
+  phash: str
+  thumb: Optional[str] = None
+  error: Optional[str] = None
+
+
+def process_file(pk: int, path: str, thumb_path: Optional[str] = None, thumb_size: int = THUMB_SIZE) -> ProcessResult:
+  """
+  计算单个文件的哈希 / 感知哈希并生成缩略图（在子进程中执行）
+
+  :param pk: Image 主键
+  :param path: 图片路径
+  :param thumb_path: 缩略图输出路径，None 表示不生成
+  :param thumb_size: 缩略图最长边
+  """
+  file = Path(path)
+  try:
+    digest = sha256_from_bytes(file)
+    size_kb = math.ceil(file.stat().st_size / 1024)
+  except OSError as e:
+    return ProcessResult(pk=pk, hash="", size_kb=0, phash="", error=str(e))
+
+  try:
+    from PIL import Image as PILImage
+  except ImportError:
+    # 没有 pillow 时只计算文件哈希
+    return ProcessResult(pk=pk, hash=digest, size_kb=size_kb, phash="")
+
+  try:
+    with PILImage.open(file) as img:
+      # JPEG 解码时直接缩小，省 CPU；缩略图也从这份彩色图生成，所以不能按灰度、也不能小于缩略图尺寸解码
+      draft_size = max(PHASH_SIZE * 4, thumb_size if thumb_path else 0)
+      img.draft("RGB", (draft_size, draft_size))
+      rgb = img.convert("RGB")
+      gray = rgb.convert("L").resize((PHASH_SIZE, PHASH_SIZE), PILImage.Resampling.LANCZOS)
+      phash = phash_to_hex(phash_pixels(list(gray.getdata())))
+
+      if thumb_path:
+        Path(thumb_path).parent.mkdir(parents=True, exist_ok=True)
+        rgb.thumbnail((thumb_size, thumb_size))
+        rgb.save(thumb_path, format="WEBP", quality=80)
+  except Exception as e:
+    return ProcessResult(pk=pk, hash=digest, size_kb=size_kb, phash="", error=str(e))
+
+  return ProcessResult(pk=pk, hash=digest, size_kb=size_kb, phash=phash, thumb=thumb_path)
+
+
+class PostProcessor:
+  """
+  下载后处理阶段
+
+  把 CPU 密集的哈希 / 缩略图计算交给进程池，结果攒批写回 Image
+
+  :param max_workers: 进程数，默认 CPU 核数
+  :param backlog: 同时在进程池中排队的文件数上限，默认 max_workers * 2
+  :param batch_size: 写回数据库的批大小
+  :param thumb_dir: 缩略图目录，None 表示不生成
+  """
+
+  def __init__(
+    self,
+    max_workers: Optional[int] = None,
+    backlog: Optional[int] = None,
+    batch_size: int = 200,
+    thumb_dir: Optional[Path] = None,
+  ):
+    self.max_workers = max_workers or os.cpu_count() or 1
+    self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+    self._slots = asyncio.Semaphore(backlog or self.max_workers * 2)
+    self.batch_size = batch_size
+    self.thumb_dir = thumb_dir
+    self._pending: set[asyncio.Task] = set()
+    self._results: list[ProcessResult] = []
+    self._flush_lock = asyncio.Lock()
+    self.processed = 0
+    self.failed = 0
+
+  async def __aenter__(self) -> "PostProcessor":
+    return self
+
+  async def __aexit__(self, exc_type, exc_val, exc_tb):
+    await self.close()
+
+  async def submit(self, image: Image, path: Path) -> None:
+    """
+    提交一个已下载的文件；进程池排满时会等待，从而对下载端形成背压
+
+    :param image: 对应的 Image 记录（需要主键）
+    :param path: 本地文件路径
+    """
+    await self._slots.acquire()
+    QUEUE_DEPTH.inc(queue="postprocess")
+    thumb = str(self.thumb_dir / f"{image.img_id}_p{image.page}.webp") if self.thumb_dir else None
+    task = asyncio.create_task(self._run(image.pk, str(path), thumb))
+    self._pending.add(task)
+    task.add_done_callback(self._pending.discard)
+
+  async def _run(self, pk: int, path: str, thumb: Optional[str]) -> None:
+    loop = asyncio.get_running_loop()
+    try:
+      with STAGE_LATENCY.time(stage="postprocess"):
+        result = await loop.run_in_executor(self.executor, process_file, pk, path, thumb)
+    except Exception as e:
+      result = ProcessResult(pk=pk, hash="", size_kb=0, phash="", error=str(e))
+    finally:
+      self._slots.release()
+      QUEUE_DEPTH.dec(queue="postprocess")
+
+    if result.error:
+      self.failed += 1
+      print(f"⚠️ 处理 {path} 失败：{result.error}")
+    if result.hash:
+      self._results.append(result)
+    if len(self._results) >= self.batch_size:
+      try:
+        await self.flush()
+      except Exception as e:
+        # 结果仍保留在 _results 中，下次 flush 时重试
+        print(f"⚠️ 写回处理结果失败，稍后重试：{e}")
+
+  async def flush(self) -> None:
+    """把已完成的结果批量写回数据库，失败时结果保留并抛出异常"""
+    async with self._flush_lock:
+      if not self._results:
+        return
+      # 写库期间仍可能有新结果追加到末尾，成功后只移除本批
+      batch = self._results[:]
+      objs = []
+      for r in batch:
+        obj = Image(hash=r.hash, size_kb=r.size_kb, phash=r.phash)
+        obj.id = r.pk
+        objs.append(obj)
+      with DB_BATCH_LATENCY.time():
+        async with in_transaction():
+          await Image.bulk_update(objs, fields=["hash", "size_kb", "phash"], batch_size=self.batch_size)
+      del self._results[: len(batch)]
+      self.processed += len(objs)
+
+  async def drain(self) -> None:
+    """等待所有已提交的任务完成并写回"""
+    if self._pending:
+      await asyncio.gather(*list(self._pending), return_exceptions=True)
+    await self.flush()
+
+  async def close(self) -> None:
+    await self.drain()
+    self.executor.shutdown(wait=True)
@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import time
+
+from bench_db import fake_illust
+from db import ImageDB
+from downloader import PixivDownloader
+from models.api import SearchArtWorkResult, SearchIllustMetaResult
+from models.db import Image
+from sql import is_sqlite
+from utils import MemoryGuard, add_insert_listener, batch_create_images, rss_bytes
+
+PAGE_SIZE = 60  # 搜索接口每页作品数
+
+
+class FakeParser:
+  """
+  模拟搜索 / meta 接口的解析器，不访问网络
+
+  :param pages: 搜索结果总页数
+  :param latency: 每次请求的模拟延迟（秒）
+  :param seed: 随机种子
+  """
+
+  def __init__(self, pages: int, latency: float, seed: int):
+    self.pages = pages
+    self.latency = latency
+    self.rng = random.Random(seed)
+    self.metas = {}
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_val, exc_tb):
+    pass
+
+  async def search_keyword(self, **kwargs) -> SearchArtWorkResult:
+    await asyncio.sleep(self.latency)
+    p = kwargs.get("p", 1)
+    illusts = []
+    for n in range((p - 1) * PAGE_SIZE, p * PAGE_SIZE):
+      illust = fake_illust(n, self.rng)
+      # meta 由 search_illust 返回，和真实接口一样
+      self.metas[illust.id] = illust.meta
+      illust.meta = []
+      illusts.append(illust)
+    return SearchArtWorkResult(Illusts=illusts, total=self.pages * PAGE_SIZE, lastPage=self.pages, error=False)
+
+  async def search_illust(self, illust_id: str) -> SearchIllustMetaResult:
+    await asyncio.sleep(self.latency)
+    return SearchIllustMetaResult(metas=self.metas.pop(illust_id), error=False)
+
+
+async def run(
+  db_url: str, pages: int, mode: str, latency: float, write_delay: float, limit_mb: int, db_cache_mb: int, seed: int
+) -> None:
+  """
+  爬取内存剖析：用模拟接口跑完整的 翻页 -> meta -> 入库 流程，按页采样 RSS
+
+  :param db_url: 数据库连接串
+  :param pages: 模拟的页数
+  :param mode: stream 为流式背压管道，list 为先收集整页列表再入库的旧方式
+  :param latency: 接口模拟延迟（秒）
+  :param write_delay: 每批入库后的额外延迟（秒），模拟数据库变慢
+  :param limit_mb: 内存上限（MiB），0 表示不限制
+  :param db_cache_mb: sqlite 页缓存大小（MiB）
+  :param seed: 随机种子
+  """
+  db = ImageDB()
+  await db.connect(db_url)
+  try:
+    if is_sqlite():
+      # sqlite 的页缓存 / mmap 在进程内，会随库变大而增长，这里压小以便只观察流水线本身的内存
+      await Image._meta.db.execute_script(f"PRAGMA cache_size = -{db_cache_mb * 1024}; PRAGMA mmap_size = 0;")
+
+    if write_delay:
+
+      async def slow_writer(images):
+        await asyncio.sleep(write_delay)
+
+      add_insert_listener(slow_writer)
+
+    parser = FakeParser(pages, latency, seed)
+    downloader = PixivDownloader(parser=parser)  # type: ignore[arg-type]
+    guard = MemoryGuard(limit_mb << 20 if limit_mb else None)
+    samples: list[tuple[int, int]] = []
+    baseline = rss_bytes() or 0
+    start = time.perf_counter()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+      if mode == "stream":
+        written = 0
+
+        async def counted():
+          nonlocal written
+          async for illust in downloader.iter_by_tag(
+            end_page=pages, guard=guard, pause_every=0, retry_delay=0, keyword="bench"
+          ):
+            written += 1
+            if written % PAGE_SIZE == 0:
+              samples.append((written // PAGE_SIZE, guard.check() or 0))
+            yield illust
+
+        await batch_create_images(counted())
+      else:
+        collected = []
+        for p in range(1, pages + 1):
+          result = await parser.search_keyword(p=p)
+          await downloader.fetch_metas(result.Illusts)
+          collected.extend(result.Illusts)
+          samples.append((p, guard.check() or 0))
+        await batch_create_images(collected)
+        samples.append((pages, guard.check() or 0))
+
+    elapsed = time.perf_counter() - start
+    print(f"📊 mode={mode} pages={pages} latency={latency}s write_delay={write_delay}s limit={limit_mb or '-'}MiB")
+    print(f"  {'page':>6} {'rss MiB':>9}")
+    step = max(pages // 10, 1)
+    for page, rss in samples:
+      if page % step == 0 or page == 1:
+        print(f"  {page:>6} {rss / 2**20:9.1f}")
+    print(f"  起始 {baseline / 2**20:.1f} MiB，峰值 {guard.peak / 2**20:.1f} MiB，暂停 {guard.pauses} 次")
+    print(f"  入库 {await db.get_image_count()} 张，耗时 {elapsed:.1f} s")
+
+  finally:
+    await db.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="爬取流程的内存剖析（模拟接口）")
+  parser.add_argument("db_url", nargs="?", default="sqlite://profile_ingest.sqlite3")
+  parser.add_argument("-p", "--pages", type=int, default=1000)
+  parser.add_argument("--mode", choices=("stream", "list"), default="stream")
+  parser.add_argument("--latency", type=float, default=0.0)
+  parser.add_argument("--write-delay", type=float, default=0.0)
+  parser.add_argument("--limit-mb", type=int, default=0)
+  parser.add_argument("--db-cache-mb", type=int, default=2)
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+  asyncio.run(
+    run(args.db_url, args.pages, args.mode, args.latency, args.write_delay, args.limit_mb, args.db_cache_mb, args.seed)
+  )
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,151 @@
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from api import APIResponseError, AuthError, PixivAPIError, PixivAPIParser, RateLimitedError
+from db import ImageDB
+from metrics import QUEUE_DEPTH, REGISTRY, span
+from utils import RateLimiter
+
+REFRESH_FAILURES = REGISTRY.counter("pixiv_refresh_failures_total", "统计刷新失败次数", ("kind",))
+MAX_REFRESH_FAILURES = 3  # 连续失败达到该次数后不再刷新（作品已删除 / 转为私密）
+
+
+@dataclass
+class RefreshTier:
+  name: str
+  interval: timedelta  # 刷新间隔
+  max_age: Optional[timedelta] = None  # 只刷新发布不超过该时长的作品
+  min_bookmarks: Optional[int] = None  # 只刷新收藏数不低于该值的作品
+  unrefreshed: bool = False  # 只刷新入库后从未刷新过的作品（stats_refreshed_at 为空）
+  batch: int = 500  # 每轮最多刷新的作品数
+
+
+# 新作统计变化最快，热门作品其次，长尾很少变化
+DEFAULT_TIERS = (
+  RefreshTier("new", interval=timedelta(0), unrefreshed=True),
+  RefreshTier("hot", interval=timedelta(days=1), max_age=timedelta(days=7)),
+  RefreshTier("warm", interval=timedelta(days=7), min_bookmarks=1000),
+  RefreshTier("cold", interval=timedelta(days=30), batch=200),
+)
+
+
+class StatsRefresher:
+  """
+  收藏 / 浏览数刷新任务
+
+  按层级挑出过期的作品，限速并发拉取统计，攒批回写
+
+  :param parser: API 解析器
+  :param db: 数据库
+  :param tiers: 刷新层级，按顺序处理
+  :param concurrency: 并发请求数
+  :param rate: 每秒请求数上限
+  :param write_batch: 回写批大小
+  """
+
+  def __init__(
+    self,
+    parser: PixivAPIParser,
+    db: ImageDB,
+    tiers: tuple[RefreshTier, ...] = DEFAULT_TIERS,
+    concurrency: int = 4,
+    rate: float = 2,
+    write_batch: int = 200,
+  ):
+    self.parser = parser
+    self.db = db
+    self.tiers = tiers
+    self.concurrency = concurrency
+    self.limiter = RateLimiter(rate)
+    self.write_batch = write_batch
+
+  async def _fetch(self, img_id: str) -> tuple[Optional[tuple[str, int, int]], bool]:
+    """
+    拉取单个作品的统计
+
+    :return: (统计行, 是否记为该作品的失败)；网络错误 / 限流 / 登录失效与作品无关，不记失败
+    """
+    await self.limiter.acquire()
+    try:
+      stats = await self.parser.get_illust_stats(img_id)
+    except (AuthError, RateLimitedError) as e:
+      print(f"⚠️ 刷新 {img_id} 失败：{e}")
+      REFRESH_FAILURES.inc(kind="account")
+      return None, False
+    except APIResponseError as e:
+      print(f"⚠️ 刷新 {img_id} 失败：{e}")
+      REFRESH_FAILURES.inc(kind="work")
+      return None, True
+    except PixivAPIError as e:
+      print(f"⚠️ 刷新 {img_id} 失败：{e}")
+      REFRESH_FAILURES.inc(kind="network")
+      return None, False
+    except Exception as e:
+      print(f"⚠️ 刷新 {img_id} 失败：{e}")
+      REFRESH_FAILURES.inc(kind="work")
+      return None, True
+    return (img_id, stats.bookmark_count, stats.view_count), False
+
+  async def refresh_tier(self, tier: RefreshTier) -> int:
+    """刷新单个层级，返回更新的作品数"""
+    now = datetime.now(timezone.utc)
+    ids = await self.db.get_stale_img_ids(
+      stale_before=now - tier.interval,
+      limit=tier.batch,
+      created_after=now - tier.max_age if tier.max_age else None,
+      min_bookmarks=tier.min_bookmarks,
+      unrefreshed=tier.unrefreshed,
+      max_failures=MAX_REFRESH_FAILURES,
+    )
+    if not ids:
+      return 0
+
+    sem = asyncio.Semaphore(self.concurrency)
+    QUEUE_DEPTH.set(len(ids), queue=f"refresh_{tier.name}")
+    results: list[tuple[str, int, int]] = []
+    failed: list[str] = []
+    updated = 0
+
+    async def worker(img_id: str):
+      async with sem:
+        row, work_failed = await self._fetch(img_id)
+        QUEUE_DEPTH.dec(queue=f"refresh_{tier.name}")
+        if row:
+          results.append(row)
+        elif work_failed:
+          failed.append(img_id)
+
+    for start in range(0, len(ids), self.write_batch):
+      chunk = ids[start : start + self.write_batch]
+      with span("refresh_fetch", tier=tier.name):
+        await asyncio.gather(*(worker(img_id) for img_id in chunk))
+      with span("refresh_write", tier=tier.name):
+        await self.db.update_stats(results)
+        # 失败的作品也要更新，否则每轮都会排在最前面，挤占整个层级
+        await self.db.mark_refresh_failed(failed)
+      updated += len(results)
+      results.clear()
+      failed.clear()
+
+    return updated
+
+  async def run_once(self) -> dict[str, int]:
+    """按顺序刷新所有层级"""
+    counts = {}
+    for tier in self.tiers:
+      counts[tier.name] = await self.refresh_tier(tier)
+    return counts
+
+  async def run_forever(self, idle: float = 600) -> None:
+    """
+    持续刷新；没有过期作品时休眠
+
+    :param idle: 空闲时的休眠时间（秒）
+    """
+    while True:
+      counts = await self.run_once()
+      print(f"♻️ 刷新完成：{counts}")
+      if not any(counts.values()):
+        await asyncio.sleep(idle)
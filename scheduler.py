@@ -0,0 +1,246 @@
+import asyncio
+import itertools
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterator, Literal, Optional
+from urllib.parse import urlsplit
+
+from anyio import Path as AsyncPath
+
+from api import PixivAPIParser
+from metrics import QUEUE_DEPTH, RETRIES, span
+from models.db import Image
+from postprocess import PostProcessor
+from ugoira import DEFAULT_FORMAT, UgoiraDownloader, ugoira_path
+from utils import RateLimiter, image_path, make_folder, save_stream
+
+Variant = Literal["original", "regular", "small"]
+
+# 数值越小越先下载
+PRIORITY_INTERACTIVE = 0
+PRIORITY_HIGH = 10
+PRIORITY_BULK = 100
+
+# 同一优先级内小图先下，先让页面能看
+VARIANT_ORDER: dict[str, int] = {"small": 0, "regular": 1, "original": 2}
+
+
+def variant_url(image: Image, variant: Variant) -> str:
+  url = (image.urls or {}).get(variant)
+  if not url:
+    raise ValueError(f"作品 {image.img_id} 没有 {variant} 尺寸的链接")
+  return url
+
+
+def is_ugoira(image: Image) -> bool:
+  return bool((image.meta or {}).get("ugoira"))
+
+
+def variant_path(save_dir: Path, image: Image, variant: Variant) -> Path:
+  """
+  各尺寸的本地保存路径，original 与 utils.image_path 一致，
+  其余尺寸带后缀: 下载目录/画师ID/作品ID_p页码_regular.jpg
+  """
+  if variant == "original":
+    return image_path(save_dir, image)
+  ext = variant_url(image, variant).rsplit(".", 1)[-1].split("?")[0] or "jpg"
+  return make_folder(save_dir, image.user_id) / f"{image.img_id}_p{image.page}_{variant}.{ext}"
+
+
+@dataclass(order=True)
+class DownloadJob:
+  key: tuple
+  url: str = field(compare=False)
+  path: Path = field(compare=False)
+  future: asyncio.Future = field(compare=False)
+  image: Optional[Image] = field(default=None, compare=False)
+  variant: Variant = field(default="original", compare=False)
+
+
+class DownloadScheduler:
+  """
+  带优先级的下载调度器
+
+  任务按 (优先级, 尺寸, -收藏数, 提交顺序) 排队，交互请求用 PRIORITY_INTERACTIVE 插队，
+  批量归档用 PRIORITY_BULK 保持带宽占满；所有 worker 共享一个按字节计的令牌桶限速，
+  并按图片服务器域名限制并发连接数；动图 (meta.ugoira) 交给 UgoiraDownloader 下载压缩包并合成
+
+  :param parser: API 解析器（或 session.RotatingAPIParser）
+  :param save_dir: 下载目录
+  :param workers: 并发下载数
+  :param per_host: 每个域名的最大并发连接数
+  :param bandwidth: 带宽上限（字节/秒），None 表示不限速
+  :param burst: 令牌桶容量（字节），默认 1 秒的带宽
+  :param retries: 单个任务的重试次数
+  :param ugoira_format: 动图合成格式 (webp / apng)，None 表示保存原始压缩包
+  :param postprocessor: 原图下载完成后交给它计算 hash / phash 并写回（需要 Image 带主键）
+  """
+
+  def __init__(
+    self,
+    parser: PixivAPIParser,
+    save_dir: Path,
+    workers: int = 8,
+    per_host: int = 4,
+    bandwidth: Optional[float] = None,
+    burst: Optional[float] = None,
+    retries: int = 2,
+    ugoira_format: Optional[str] = DEFAULT_FORMAT,
+    postprocessor: Optional[PostProcessor] = None,
+  ):
+    self.parser = parser
+    self.save_dir = save_dir
+    self.workers = workers
+    self.retries = retries
+    self.ugoira_format = ugoira_format
+    self.postprocessor = postprocessor
+    self.limiter = RateLimiter(bandwidth, burst or bandwidth) if bandwidth else None
+    self._ugoira: Optional[UgoiraDownloader] = None
+    self._host_limits: defaultdict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(per_host))
+    self._queue: asyncio.PriorityQueue[DownloadJob] = asyncio.PriorityQueue()
+    self._seq = itertools.count()
+    self._tasks: list[asyncio.Task] = []
+
+  async def __aenter__(self) -> "DownloadScheduler":
+    self.start()
+    return self
+
+  async def __aexit__(self, exc_type, exc_val, exc_tb):
+    await self.close()
+
+  def start(self) -> None:
+    if not self._tasks:
+      self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+  async def close(self) -> None:
+    for task in self._tasks:
+      task.cancel()
+    await asyncio.gather(*self._tasks, return_exceptions=True)
+    self._tasks = []
+    # 未开始的任务直接取消，避免调用方一直等待
+    while not self._queue.empty():
+      job = self._queue.get_nowait()
+      job.future.cancel()
+      self._queue.task_done()
+    QUEUE_DEPTH.set(0, queue="download")
+    if self._ugoira:
+      # 进程池 shutdown(wait=True) 会等正在合成的动图，放到线程里避免卡住事件循环
+      await asyncio.to_thread(self._ugoira.close)
+      self._ugoira = None
+
+  def submit_url(
+    self,
+    url: str,
+    path: Path,
+    priority: int = PRIORITY_BULK,
+    rank: tuple = (),
+    image: Optional[Image] = None,
+    variant: Variant = "original",
+  ) -> asyncio.Future:
+    """
+    提交任意链接的下载任务
+
+    :param url: 资源 URL
+    :param path: 保存路径
+    :param priority: 优先级，数值越小越先下载
+    :param rank: 同优先级内的排序键
+    :param image: 对应的图片记录
+    :param variant: 尺寸
+    :return: 完成后结果为保存路径的 Future
+    """
+    future = asyncio.get_running_loop().create_future()
+    self._queue.put_nowait(DownloadJob((priority, *rank, next(self._seq)), url, path, future, image, variant))
+    QUEUE_DEPTH.inc(queue="download")
+    return future
+
+  def submit(self, image: Image, variant: Variant = "original", priority: int = PRIORITY_BULK) -> asyncio.Future:
+    """
+    提交一张图片的下载任务
+
+    :param image: 图片
+    :param variant: 尺寸 (original / regular / small)
+    :param priority: 优先级，例如不同 tag 任务使用不同的值
+    """
+    rank = (VARIANT_ORDER[variant], -(image.bookmarks or 0))
+    if is_ugoira(image):
+      # 动图只有一页，链接来自 ugoira_meta 接口，这里的 url 只用于限流分组和日志
+      path = ugoira_path(make_folder(self.save_dir, image.user_id), image.img_id, self.ugoira_format)
+      return self.submit_url(variant_url(image, "regular"), path, priority, rank, image, variant)
+    return self.submit_url(
+      variant_url(image, variant), variant_path(self.save_dir, image, variant), priority, rank, image, variant
+    )
+
+  async def fetch(self, image: Image, variant: Variant = "regular") -> Path:
+    """交互请求：插到队首并等待下载完成"""
+    return await self.submit(image, variant, PRIORITY_INTERACTIVE)
+
+  async def join(self) -> None:
+    """等待队列中的任务全部完成"""
+    await self._queue.join()
+
+  async def _worker(self) -> None:
+    while True:
+      job = await self._queue.get()
+      QUEUE_DEPTH.dec(queue="download")
+      try:
+        if not job.future.cancelled():
+          path = await self._download(job)
+          await self._postprocess(job, path)
+          job.future.set_result(path)
+      except asyncio.CancelledError:
+        job.future.cancel()
+        raise
+      except Exception as e:
+        print(f"下载 {job.url} 失败: {e}")
+        if not job.future.cancelled():
+          job.future.set_exception(e)
+          # 调用方不关心结果时避免 "exception was never retrieved"
+          job.future.exception()
+      finally:
+        self._queue.task_done()
+
+  def _ugoira_downloader(self) -> UgoiraDownloader:
+    if self._ugoira is None:
+      self._ugoira = UgoiraDownloader(self.parser, limiter=self.limiter)
+    return self._ugoira
+
+  async def _postprocess(self, job: DownloadJob, path: Path) -> None:
+    """原图交给后处理；已处理过（hash 非空）的跳过"""
+    image = job.image
+    if self.postprocessor is None or image is None or image.pk is None:
+      return
+    if job.variant != "original" or is_ugoira(image) or image.hash:
+      return
+    await self.postprocessor.submit(image, path)
+
+  async def _download(self, job: DownloadJob) -> Path:
+    if await AsyncPath(job.path).exists():
+      return job.path
+    host = urlsplit(job.url).hostname or ""
+    attempt = 0
+    while True:
+      try:
+        async with self._host_limits[host]:
+          if job.image is not None and is_ugoira(job.image):
+            with span("download_ugoira", host=host):
+              return await self._ugoira_downloader().download(
+                job.image.img_id, job.path.parent, self.ugoira_format, original=job.variant == "original"
+              )
+          with span("download", host=host):
+            await save_stream(job.path, self._iter_download(job.url))
+          return job.path
+      except asyncio.CancelledError:
+        raise
+      except Exception:
+        if attempt >= self.retries:
+          raise
+        attempt += 1
+        RETRIES.inc(stage="download")
+        await asyncio.sleep(2**attempt)
+
+  async def _iter_download(self, url: str) -> AsyncIterator[bytes]:
+    async for chunk in self.parser.iter_download(url):
+      if self.limiter:
+        await self.limiter.acquire(len(chunk))
+      yield chunk
@@ -0,0 +1,212 @@
+import base64
+import hashlib
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+from cache import CachedImageDB
+from db import DATABASE_URL, ImageFilter
+from metrics import REGISTRY, SERVER_LATENCY
+
+load_dotenv()
+HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+PORT = int(os.getenv("SERVER_PORT", "8080"))
+FILES_DIR = os.getenv("FILES_DIR")  # 本地下载目录，设置后通过 /files 提供文件
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "5"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+REDIS_URL = os.getenv("REDIS_URL") or None
+
+MAX_PAGE_SIZE = 100
+LIST_COLUMNS = (
+  "id",
+  "img_id",
+  "page",
+  "page_count",
+  "title",
+  "tags",
+  "urls",
+  "user_id",
+  "user_name",
+  "width",
+  "height",
+  "bookmarks",
+  "views",
+  "x_restrict",
+  "ai_type",
+  "created",
+  "file_ext",
+)
+
+DB_KEY = web.AppKey("db", CachedImageDB)
+FILES_ROOT_KEY = web.AppKey("files_root", Path)
+
+
+def with_pool_size(url: str, minsize: int, maxsize: int) -> str:
+  """给 postgres 连接串补上连接池参数（已有的参数不覆盖）"""
+  parts = urlsplit(url)
+  if not parts.scheme.startswith("postgres"):
+    return url
+  params = dict(parse_qsl(parts.query))
+  params.setdefault("minsize", str(minsize))
+  params.setdefault("maxsize", str(maxsize))
+  return urlunsplit(parts._replace(query=urlencode(params)))
+
+
+def encode_cursor(row: dict[str, Any]) -> str:
+  raw = f"{row['created'].isoformat()}|{row['id']}"
+  return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(value: Optional[str]) -> Optional[tuple[datetime, int]]:
+  if not value:
+    return None
+  try:
+    raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)).decode()
+    created, last_id = raw.rsplit("|", 1)
+    return datetime.fromisoformat(created), int(last_id)
+  except ValueError as e:
+    raise web.HTTPBadRequest(text="无效的 cursor") from e
+
+
+def _int_param(request: web.Request, name: str, default: int, maximum: int) -> int:
+  try:
+    value = int(request.query.get(name, default))
+  except ValueError as e:
+    raise web.HTTPBadRequest(text=f"无效的 {name}") from e
+  return max(1, min(value, maximum))
+
+
+def _json_default(value: Any) -> Any:
+  if isinstance(value, datetime):
+    return value.isoformat()
+  raise TypeError(f"无法序列化 {type(value)}")
+
+
+def json_response(request: web.Request, data: Any, max_age: int = 10) -> web.Response:
+  """带 ETag / 条件请求 / 压缩的 JSON 响应"""
+  body = json.dumps(data, ensure_ascii=False, default=_json_default, separators=(",", ":")).encode()
+  etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+  headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}"}
+
+  if etag in request.headers.get("If-None-Match", ""):
+    return web.Response(status=304, headers=headers)
+
+  resp = web.Response(body=body, content_type="application/json", headers=headers)
+  if len(body) > 1024:
+    resp.enable_compression()
+  return resp
+
+
+async def list_images(request: web.Request, filters: ImageFilter) -> web.Response:
+  db = request.app[DB_KEY]
+  limit = _int_param(request, "limit", 20, MAX_PAGE_SIZE)
+  cursor = decode_cursor(request.query.get("cursor"))
+  rows = await db.get_images_keyset(filters, cursor, limit, LIST_COLUMNS)
+  next_cursor = encode_cursor(rows[-1]) if len(rows) == limit else None
+  return json_response(request, {"items": rows, "next": next_cursor})
+
+
+async def images_by_tag(request: web.Request) -> web.Response:
+  return await list_images(request, {"tags": [request.match_info["tag"]]})
+
+
+async def images_by_user(request: web.Request) -> web.Response:
+  return await list_images(request, {"user_id": request.match_info["user_id"]})
+
+
+async def recent_images(request: web.Request) -> web.Response:
+  return await list_images(request, {})
+
+
+async def search_images(request: web.Request) -> web.Response:
+  keyword = request.query.get("q", "").strip()
+  if not keyword:
+    raise web.HTTPBadRequest(text="缺少参数 q")
+  filters: ImageFilter = {"keyword": keyword}
+  if "tag" in request.query:
+    filters["tags"] = request.query.getall("tag")
+  return await list_images(request, filters)
+
+
+async def top_tags(request: web.Request) -> web.Response:
+  db = request.app[DB_KEY]
+  limit = _int_param(request, "limit", 30, 500)
+  rows = await db.get_top_tags(limit)
+  return json_response(request, [{"tag": tag, "count": count} for tag, count in rows], max_age=60)
+
+
+async def tag_count(request: web.Request) -> web.Response:
+  db = request.app[DB_KEY]
+  tag = request.match_info["tag"]
+  return json_response(request, {"tag": tag, "count": await db.count_images_by_tag(tag)}, max_age=60)
+
+
+async def stats(request: web.Request) -> web.Response:
+  db = request.app[DB_KEY]
+  return json_response(request, await db.get_stats(), max_age=60)
+
+
+async def serve_file(request: web.Request) -> web.FileResponse:
+  """通过 sendfile 返回本地已下载的图片"""
+  root = request.app[FILES_ROOT_KEY]
+  path = (root / request.match_info["user_id"] / request.match_info["name"]).resolve()
+  if not path.is_relative_to(root) or not path.is_file():
+    raise web.HTTPNotFound()
+  return web.FileResponse(path, headers={"Cache-Control": "public, max-age=86400, immutable"})
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+  return web.Response(text=REGISTRY.to_prometheus(), content_type="text/plain")
+
+
+@web.middleware
+async def timing_middleware(request: web.Request, handler):
+  route = request.match_info.route.resource.canonical if request.match_info.route.resource else "unknown"
+  with SERVER_LATENCY.time(route=route):
+    return await handler(request)
+
+
+def create_app(db: Optional[CachedImageDB] = None, files_dir: Optional[str] = FILES_DIR) -> web.Application:
+  """
+  创建只读查询服务
+
+  :param db: 数据库，默认新建带缓存的 ImageDB
+  :param files_dir: 本地下载目录，None 表示不提供文件
+  """
+  app = web.Application(middlewares=[timing_middleware])
+  app[DB_KEY] = db or CachedImageDB(redis_url=REDIS_URL)
+
+  async def on_startup(app: web.Application):
+    # 只读服务不建表 / 迁移 / 回填，这些由写入端负责
+    await app[DB_KEY].connect(with_pool_size(DATABASE_URL or "", DB_POOL_MIN, DB_POOL_MAX), read_only=True)
+
+  async def on_cleanup(app: web.Application):
+    await app[DB_KEY].close()
+
+  app.on_startup.append(on_startup)
+  app.on_cleanup.append(on_cleanup)
+
+  app.router.add_get("/api/recent", recent_images)
+  app.router.add_get("/api/search", search_images)
+  app.router.add_get("/api/stats", stats)
+  app.router.add_get("/api/tags/top", top_tags)
+  app.router.add_get("/api/tags/{tag}/images", images_by_tag)
+  app.router.add_get("/api/tags/{tag}/count", tag_count)
+  app.router.add_get("/api/users/{user_id}/images", images_by_user)
+  app.router.add_get("/metrics", metrics_handler)
+
+  if files_dir:
+    app[FILES_ROOT_KEY] = Path(files_dir).resolve()
+    app.router.add_get("/files/{user_id}/{name}", serve_file)
+
+  return app
+
+
+if __name__ == "__main__":
+  web.run_app(create_app(), host=HOST, port=PORT)
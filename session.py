@@ -0,0 +1,250 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Optional
+
+from api import APIResponseError, AuthError, NetworkError, PixivAPIError, PixivAPIParser, RateLimitedError
+from metrics import REGISTRY
+from utils import RateLimiter, is_token_expired
+
+SESSION_STATE = REGISTRY.gauge("pixiv_session_healthy", "会话是否可用 (1/0)", ("account",))
+SESSION_ERRORS = REGISTRY.counter("pixiv_session_errors_total", "会话错误次数", ("account", "kind"))
+
+
+class AccountSession:
+  """
+  单个账号的会话
+
+  :param name: 账号标识（用于日志和指标，不含 token）
+  :param token: PHPSESSID
+  :param proxy: 代理地址
+  :param rate: 每秒请求数上限
+  :param burst: 允许的突发请求数
+  """
+
+  def __init__(self, name: str, token: str, proxy: Optional[str], rate: float, burst: float):
+    self.name = name
+    self.parser = PixivAPIParser()
+    self.parser.set_token(token)
+    if proxy:
+      self.parser.set_proxy(proxy)
+    self.limiter = RateLimiter(rate, burst)
+    self.failures = 0  # 连续失败次数
+    self.invalid = False  # 登录失效，需要重新验证
+    self.cooldown_until = 0.0
+    self.inflight = 0
+    # 验证结果的有效期，过期后使用前重新验证（沿用 is_token_expired 的格式）
+    self.validation: dict[str, str] = {}
+
+  def available(self, now: float) -> bool:
+    return not self.invalid and now >= self.cooldown_until
+
+  def set_healthy(self, healthy: bool) -> None:
+    SESSION_STATE.set(1 if healthy else 0, account=self.name)
+
+  async def validate(self, ttl: timedelta) -> bool:
+    ok = await self.parser.check_login()
+    self.invalid = not ok
+    self.failures = 0
+    if ok:
+      self.validation = {"expire_time": (datetime.now() + ttl).isoformat()}
+    self.set_healthy(ok)
+    return ok
+
+  async def close(self) -> None:
+    await self.parser.close()
+
+
+class SessionManager:
+  """
+  多账号会话管理
+
+  启动时验证所有 cookie；请求按各账号剩余额度分摊；
+  登录失效的账号隔离后定期重新验证，网络错误 / 429 的账号短暂冷却，都不会阻塞其他账号
+
+  :param tokens: PHPSESSID 列表
+  :param proxy: 代理地址
+  :param rate: 每个账号每秒请求数上限
+  :param burst: 每个账号允许的突发请求数
+  :param max_failures: 连续失败多少次后冷却
+  :param cooldown: 冷却时间（秒）
+  :param revalidate: 失效账号多久后重新验证（秒）
+  :param validation_ttl: 验证结果的有效期
+  """
+
+  def __init__(
+    self,
+    tokens: list[str],
+    proxy: Optional[str] = None,
+    rate: float = 2,
+    burst: float = 5,
+    max_failures: int = 3,
+    cooldown: float = 60,
+    revalidate: float = 1800,
+    validation_ttl: timedelta = timedelta(hours=1),
+  ):
+    if not tokens:
+      raise ValueError("至少需要一个 PHPSESSID")
+    self.sessions = [AccountSession(f"account{i}", token, proxy, rate, burst) for i, token in enumerate(tokens)]
+    self.max_failures = max_failures
+    self.cooldown = cooldown
+    self.revalidate = revalidate
+    self.validation_ttl = validation_ttl
+    self._changed = asyncio.Event()
+
+  async def __aenter__(self) -> "SessionManager":
+    return self
+
+  async def __aexit__(self, exc_type, exc_val, exc_tb):
+    await self.close()
+
+  async def close(self) -> None:
+    await asyncio.gather(*(s.close() for s in self.sessions))
+
+  async def validate_all(self) -> int:
+    """并发验证所有账号，返回可用账号数"""
+    results = await asyncio.gather(*(s.validate(self.validation_ttl) for s in self.sessions), return_exceptions=True)
+    healthy = 0
+    for session, ok in zip(self.sessions, results):
+      if ok is True:
+        healthy += 1
+      else:
+        session.invalid = True
+        session.cooldown_until = time.monotonic() + self.revalidate
+        session.set_healthy(False)
+        print(f"🔒 {session.name} 登录验证失败：{ok if isinstance(ok, Exception) else '未登录'}")
+    print(f"🔑 可用账号 {healthy}/{len(self.sessions)}")
+    return healthy
+
+  async def _revalidate_due(self, now: float) -> None:
+    """重新验证已到期的失效账号"""
+    due = [s for s in self.sessions if s.invalid and now >= s.cooldown_until]
+    for session in due:
+      # 先推迟下次验证，避免并发请求重复验证
+      session.cooldown_until = now + self.revalidate
+    for session in due:
+      try:
+        if await session.validate(self.validation_ttl):
+          print(f"🔓 {session.name} 恢复可用")
+          self._changed.set()
+      except PixivAPIError as e:
+        print(f"🔒 {session.name} 重新验证失败：{e}")
+
+  async def acquire(self, consume: bool = True) -> AccountSession:
+    """
+    选出剩余额度最多的可用账号并扣除一次额度，全部不可用时等待
+
+    :param consume: 是否扣除 API 额度；图片下载走图片服务器，不占 API 的请求频率
+    """
+    while True:
+      now = time.monotonic()
+      await self._revalidate_due(now)
+      candidates = [s for s in self.sessions if s.available(now)]
+      if candidates:
+        session = max(candidates, key=lambda s: (s.limiter.available(), -s.inflight))
+        if is_token_expired(session.validation):
+          try:
+            valid = await session.validate(self.validation_ttl)
+          except PixivAPIError:
+            self._cool_down(session, "network")
+            continue
+          if not valid:
+            self._quarantine(session, "expired")
+            continue
+        if consume:
+          await session.limiter.acquire()
+        return session
+
+      wake = min(s.cooldown_until for s in self.sessions)
+      self._changed.clear()
+      try:
+        await asyncio.wait_for(self._changed.wait(), timeout=max(wake - now, 0.1))
+      except asyncio.TimeoutError:
+        pass
+
+  def _quarantine(self, session: AccountSession, kind: str) -> None:
+    session.invalid = True
+    session.cooldown_until = time.monotonic() + self.revalidate
+    session.set_healthy(False)
+    SESSION_ERRORS.inc(account=session.name, kind=kind)
+    print(f"🔒 {session.name} 登录失效，已隔离")
+
+  def _cool_down(self, session: AccountSession, kind: str) -> None:
+    SESSION_ERRORS.inc(account=session.name, kind=kind)
+    session.failures += 1
+    if kind == "rate_limited" or session.failures >= self.max_failures:
+      session.cooldown_until = time.monotonic() + self.cooldown
+      session.failures = 0
+      print(f"🧊 {session.name} 冷却 {self.cooldown:.0f} 秒（{kind}）")
+
+  async def call(self, method: str, *args: Any, **kwargs: Any) -> Any:
+    """
+    用一个可用账号调用 PixivAPIParser 的方法，账号失效 / 被限流 / 网络错误时换号重试
+
+    :param method: PixivAPIParser 的方法名
+    """
+    last_error: Optional[Exception] = None
+    for _ in range(len(self.sessions) + 1):
+      session = await self.acquire()
+      session.inflight += 1
+      try:
+        result = await getattr(session.parser, method)(*args, **kwargs)
+        session.failures = 0
+        return result
+      except AuthError as e:
+        self._quarantine(session, "auth")
+        last_error = e
+      except RateLimitedError as e:
+        self._cool_down(session, "rate_limited")
+        last_error = e
+      except NetworkError as e:
+        self._cool_down(session, "network")
+        last_error = e
+      except APIResponseError:
+        # 作品不存在等业务错误，与账号无关
+        raise
+      finally:
+        session.inflight -= 1
+    raise last_error or PixivAPIError("没有可用的会话")
+
+  def parser(self) -> "RotatingAPIParser":
+    return RotatingAPIParser(self)
+
+
+class RotatingAPIParser:
+  """
+  与 PixivAPIParser 接口一致的多账号代理，可直接传给 PixivDownloader
+
+  :param manager: 会话管理器
+  """
+
+  def __init__(self, manager: SessionManager):
+    self.manager = manager
+
+  async def __aenter__(self) -> "RotatingAPIParser":
+    return self
+
+  async def __aexit__(self, exc_type, exc_val, exc_tb):
+    await self.close()
+
+  async def close(self) -> None:
+    await self.manager.close()
+
+  def __getattr__(self, name: str):
+    if name.startswith("_") or not callable(getattr(PixivAPIParser, name, None)):
+      raise AttributeError(name)
+
+    async def method(*args: Any, **kwargs: Any) -> Any:
+      return await self.manager.call(name, *args, **kwargs)
+
+    return method
+
+  # 图片服务器不校验登录，下载不需要换号重试，也不扣 API 额度（带宽由调用方限速）
+  async def iter_download(self, *args: Any, **kwargs: Any) -> AsyncIterator[bytes]:
+    session = await self.manager.acquire(consume=False)
+    async for chunk in session.parser.iter_download(*args, **kwargs):
+      yield chunk
+
+  async def download(self, *args: Any, **kwargs: Any) -> None:
+    session = await self.manager.acquire(consume=False)
+    await session.parser.download(*args, **kwargs)
@@ -0,0 +1,17 @@
+from models.db import Image
+
+
+def dialect() -> str:
+  """当前连接的数据库方言: postgres / sqlite"""
+  return Image._meta.db.capabilities.dialect
+
+
+def is_sqlite() -> bool:
+  return dialect() == "sqlite"
+
+
+def sql_params(count: int, start: int = 1) -> list[str]:
+  """生成 SQL 占位符，postgres 为 $1, $2, ...，sqlite 为 ?"""
+  if is_sqlite():
+    return ["?"] * count
+  return [f"${i}" for i in range(start, start + count)]
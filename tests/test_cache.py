@@ -0,0 +1,281 @@
+import asyncio
+
+import pytest
+
+from cache import _MISSING, CachedImageDB, RedisCache
+from db import ImageDB
+
+
+class FakeRedis:
+  """只实现 GET / SET / DEL / SADD / SMEMBERS 的内存 RESP 服务，用于测试 RedisCache"""
+
+  def __init__(self):
+    self.data: dict[bytes, bytes | set[bytes]] = {}
+    self.commands: list[list[bytes]] = []
+    self.connections = 0
+    self.stalled = False  # 为 True 时收下命令但不回复，模拟卡住的 Redis
+    self.server: asyncio.Server | None = None
+
+  async def start(self) -> str:
+    self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+    port = self.server.sockets[0].getsockname()[1]
+    return f"redis://127.0.0.1:{port}/0"
+
+  async def stop(self) -> None:
+    assert self.server is not None
+    self.server.close()
+    await self.server.wait_closed()
+
+  async def _read_command(self, reader: asyncio.StreamReader) -> list[bytes] | None:
+    line = await reader.readline()
+    if not line:
+      return None
+    assert line[:1] == b"*"
+    args = []
+    for _ in range(int(line[1:-2])):
+      size = int((await reader.readline())[1:-2])
+      args.append((await reader.readexactly(size + 2))[:-2])
+    return args
+
+  async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    self.connections += 1
+    while (args := await self._read_command(reader)) is not None:
+      self.commands.append(args)
+      if self.stalled:
+        continue
+      name = args[0].upper()
+      if name == b"GET":
+        value = self.data.get(args[1])
+        writer.write(b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value))
+      elif name == b"SET":
+        self.data[args[1]] = args[2]
+        writer.write(b"+OK\r\n")
+      elif name == b"DEL":
+        removed = sum(self.data.pop(key, None) is not None for key in args[1:])
+        writer.write(b":%d\r\n" % removed)
+      elif name == b"SADD":
+        members = self.data.setdefault(args[1], set())
+        added = len(set(args[2:]) - members)
+        members.update(args[2:])
+        writer.write(b":%d\r\n" % added)
+      elif name == b"SMEMBERS":
+        members = self.data.get(args[1], set())
+        writer.write(b"*%d\r\n" % len(members) + b"".join(b"$%d\r\n%s\r\n" % (len(m), m) for m in members))
+      else:
+        writer.write(b"-ERR unknown command\r\n")
+      await writer.drain()
+    writer.close()
+
+
+def run_with_redis(test):
+  async def runner():
+    fake = FakeRedis()
+    url = await fake.start()
+    try:
+      await test(fake, url)
+    finally:
+      await fake.stop()
+
+  asyncio.run(runner())
+
+
+def test_redis_cache_roundtrip():
+  async def test(fake: FakeRedis, url: str):
+    cache = RedisCache(url, prefix="t:")
+    assert await cache.get("missing") is _MISSING
+    await cache.set("k", {"n": 1}, ttl=1)
+    assert await cache.get("k") == {"n": 1}
+    assert [b"SET", b"t:k", b'{"n": 1}', b"PX", b"1000"] in fake.commands
+    await cache.delete("k")
+    assert b"t:k" not in fake.data
+    await cache.close()
+
+  run_with_redis(test)
+
+
+def test_stalled_redis_times_out_and_reconnects():
+  async def test(fake: FakeRedis, url: str):
+    cache = RedisCache(url, timeout=0.1)
+    await cache.set("k", 1, ttl=10)
+    fake.stalled = True
+    with pytest.raises(asyncio.TimeoutError):
+      await cache.get("k")
+    # 超时的连接上可能晚到旧响应，必须丢弃后重连
+    fake.stalled = False
+    assert await cache.get("k") == 1
+    assert fake.connections == 2
+    await cache.close()
+
+  run_with_redis(test)
+
+
+def test_stalled_redis_does_not_block_invalidation():
+  async def test(fake: FakeRedis, url: str):
+    db = CachedImageDB(redis_url=url)
+    db.shared.timeout = 0.1
+    fake.stalled = True
+    # 入库监听里的失效只记录错误，不会一直卡住
+    await asyncio.wait_for(db.invalidate_tags({"a"}), 1)
+    await db.close()
+
+  run_with_redis(test)
+
+
+def test_miss_then_local_and_shared_hit():
+  async def test(fake: FakeRedis, url: str):
+    calls = 0
+
+    async def loader():
+      nonlocal calls
+      calls += 1
+      return 42
+
+    db = CachedImageDB(redis_url=url)
+    assert await db._cached("count", loader) == 42
+    assert await db._cached("count", loader) == 42
+    assert calls == 1
+
+    # 另一个进程：进程内缓存为空，命中 Redis
+    other = CachedImageDB(redis_url=url)
+    assert await other._cached("count", loader) == 42
+    assert calls == 1
+    await db.close()
+    await other.close()
+
+  run_with_redis(test)
+
+
+def test_invalidate_tags_clears_both_tiers():
+  async def test(fake: FakeRedis, url: str):
+    db = CachedImageDB(redis_url=url)
+    counts = {"a": 1}
+
+    async def count_a():
+      return counts["a"]
+
+    assert await db._cached("tag:a:count", count_a) == 1
+    counts["a"] = 2
+    assert await db._cached("tag:a:count", count_a) == 1
+
+    await db.invalidate_tags({"a"})
+    assert b"pixiv:tag:a:count" not in fake.data
+    assert await db._cached("tag:a:count", count_a) == 2
+    await db.close()
+
+  run_with_redis(test)
+
+
+def test_stats_are_cached_and_invalidated_on_insert(monkeypatch):
+  async def test(fake: FakeRedis, url: str):
+    calls = 0
+
+    async def get_stats(self):
+      nonlocal calls
+      calls += 1
+      return {"images": calls}
+
+    monkeypatch.setattr(ImageDB, "get_stats", get_stats)
+    db = CachedImageDB(redis_url=url)
+    assert await db.get_stats() == {"images": 1}
+    assert await db.get_stats() == {"images": 1}
+    assert calls == 1
+
+    await db.invalidate_tags({"a"})
+    assert await db.get_stats() == {"images": 2}
+    await db.close()
+
+  run_with_redis(test)
+
+
+def test_invalidation_reaches_keys_cached_by_other_process():
+  async def test(fake: FakeRedis, url: str):
+    reader = CachedImageDB(redis_url=url)
+    writer = CachedImageDB(redis_url=url)
+
+    async def top():
+      return [["a", 1]]
+
+    # 查询服务缓存了 top:50，写入端从未用过这个 limit
+    assert await reader._cached("top:50", top, index="keys:top") == [["a", 1]]
+    assert fake.data[b"pixiv:keys:top"] == {b"top:50"}
+
+    await writer.invalidate_tags({"a"})
+    assert b"pixiv:top:50" not in fake.data
+    await reader.close()
+    await writer.close()
+
+  run_with_redis(test)
+
+
+def test_single_flight_coalesces_concurrent_misses():
+  async def test(fake: FakeRedis, url: str):
+    db = CachedImageDB(redis_url=url)
+    calls = 0
+    release = asyncio.Event()
+
+    async def loader():
+      nonlocal calls
+      calls += 1
+      await release.wait()
+      return "v"
+
+    tasks = [asyncio.create_task(db._cached("k", loader)) for _ in range(10)]
+    await asyncio.sleep(0.05)
+    release.set()
+    assert await asyncio.gather(*tasks) == ["v"] * 10
+    assert calls == 1
+    await db.close()
+
+  run_with_redis(test)
+
+
+def test_single_flight_survives_leader_cancellation():
+  async def test(fake: FakeRedis, url: str):
+    db = CachedImageDB(redis_url=url)
+    calls = 0
+    release = asyncio.Event()
+
+    async def loader():
+      nonlocal calls
+      calls += 1
+      await release.wait()
+      return "v"
+
+    leader = asyncio.create_task(db._cached("k", loader))
+    await asyncio.sleep(0.01)
+    follower = asyncio.create_task(db._cached("k", loader))
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    await asyncio.sleep(0.01)
+    release.set()
+
+    assert await follower == "v"
+    assert leader.cancelled()
+    assert calls == 1
+    await db.close()
+
+  run_with_redis(test)
+
+
+def test_single_flight_propagates_errors_without_caching():
+  async def test(fake: FakeRedis, url: str):
+    db = CachedImageDB(redis_url=url)
+    attempts = 0
+
+    async def failing():
+      nonlocal attempts
+      attempts += 1
+      await asyncio.sleep(0.01)
+      raise RuntimeError("db down")
+
+    results = await asyncio.gather(*(db._cached("k", failing) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert attempts == 1
+
+    async def ok():
+      return "v"
+
+    assert await db._cached("k", ok) == "v"
+    await db.close()
+
+  run_with_redis(test)
@@ -0,0 +1,36 @@
+import pytest
+
+from postprocess import hamming, process_file
+
+PILImage = pytest.importorskip("PIL.Image")
+
+
+def test_jpeg_thumbnail_keeps_colour_and_size(tmp_path):
+  src = tmp_path / "red.jpg"
+  PILImage.new("RGB", (1200, 800), (255, 0, 0)).save(src, format="JPEG", quality=95)
+  thumb = tmp_path / "thumbs" / "red.webp"
+
+  result = process_file(1, str(src), str(thumb), thumb_size=256)
+
+  assert result.error is None
+  assert result.hash and len(result.phash) == 16
+  with PILImage.open(thumb) as img:
+    assert img.mode == "RGB"
+    assert max(img.size) == 256
+    r, g, b = img.getpixel((img.width // 2, img.height // 2))
+    assert r > 200 and g < 60 and b < 60
+
+
+def test_phash_survives_recompression(tmp_path):
+  from PIL import ImageDraw
+
+  image = PILImage.new("RGB", (640, 480), (240, 240, 240))
+  draw = ImageDraw.Draw(image)
+  draw.rectangle((40, 60, 300, 400), fill=(200, 30, 30))
+  draw.ellipse((320, 100, 600, 380), fill=(20, 60, 200))
+  a, b = tmp_path / "a.jpg", tmp_path / "b.png"
+  image.save(a, format="JPEG", quality=60)
+  image.save(b, format="PNG")
+
+  pa, pb = process_file(1, str(a)).phash, process_file(2, str(b)).phash
+  assert hamming(int(pa, 16), int(pb, 16)) <= 6
@@ -0,0 +1,207 @@
+import asyncio
+import importlib.util
+import io
+import os
+import struct
+import zlib
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+from anyio import Path as AsyncPath
+
+from api import PixivAPIParser
+from metrics import span
+from models.api import UgoiraMeta
+from utils import RateLimiter, part_path, save_stream
+
+LOCAL_HEADER_SIG = b"PK\x03\x04"
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")  # 30 字节
+FLAG_DATA_DESCRIPTOR = 0x08
+
+ANIMATION_FORMATS = ("webp", "apng")
+# 没装 pillow 时无法合成，直接保存原始压缩包
+DEFAULT_FORMAT: Optional[str] = "webp" if importlib.util.find_spec("PIL") else None
+
+
+class UgoiraError(Exception):
+  """动图处理异常"""
+
+  pass
+
+
+async def iter_zip_frames(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[str, bytes]]:
+  """
+  边下载边解析 zip，按顺序返回 (文件名, 内容)
+
+  p站的动图压缩包是 stored 模式且本地文件头里带有大小，可以只靠本地文件头顺序读取，
+  不需要等待中央目录，也不落盘
+  """
+  buf = bytearray()
+  done = False
+
+  async def fill(size: int) -> bool:
+    nonlocal done
+    while len(buf) < size and not done:
+      try:
+        buf.extend(await anext(chunks))
+      except StopAsyncIteration:
+        done = True
+    return len(buf) >= size
+
+  while await fill(4):
+    if buf[:4] != LOCAL_HEADER_SIG:
+      # 已到中央目录
+      return
+    if not await fill(LOCAL_HEADER.size):
+      raise UgoiraError("压缩包不完整")
+
+    _, _, flags, method, _, _, _, csize, _, name_len, extra_len = LOCAL_HEADER.unpack_from(buf)
+    if flags & FLAG_DATA_DESCRIPTOR:
+      raise UgoiraError("不支持带数据描述符的压缩包")
+    if method not in (0, 8):
+      raise UgoiraError(f"不支持的压缩方式: {method}")
+
+    total = LOCAL_HEADER.size + name_len + extra_len + csize
+    if not await fill(total):
+      raise UgoiraError("压缩包不完整")
+
+    name = bytes(buf[LOCAL_HEADER.size : LOCAL_HEADER.size + name_len]).decode("utf-8", "replace")
+    data = bytes(buf[total - csize : total])
+    del buf[:total]
+
+    if method == 8:
+      data = zlib.decompress(data, -zlib.MAX_WBITS)
+    yield name, data
+
+
+def assemble_animation(frames: list[bytes], delays: list[int], out_path: str, fmt: str = "webp") -> int:
+  """
+  把帧合成为动画（在子进程中执行）
+
+  :param frames: 按顺序排列的帧图片内容
+  :param delays: 每帧延迟（毫秒）
+  :param out_path: 输出路径
+  :param fmt: webp / apng
+  :return: 输出文件大小（字节）
+  """
+  try:
+    from PIL import Image as PILImage
+  except ImportError as e:
+    raise UgoiraError("合成动图需要安装 pillow: uv add pillow") from e
+
+  images = [PILImage.open(io.BytesIO(frame)) for frame in frames]
+  first, rest = images[0], images[1:]
+  options = {"save_all": True, "append_images": rest, "duration": delays, "loop": 0}
+  # 先写临时文件再改名，进程中途退出不会留下被当成已完成的半个文件
+  tmp = part_path(Path(out_path))
+  try:
+    if fmt == "webp":
+      first.save(tmp, format="WEBP", quality=90, method=4, **options)
+    elif fmt == "apng":
+      first.save(tmp, format="PNG", **options)
+    else:
+      raise UgoiraError(f"不支持的动图格式: {fmt}")
+    os.replace(tmp, out_path)
+  except BaseException:
+    tmp.unlink(missing_ok=True)
+    raise
+  return Path(out_path).stat().st_size
+
+
+def ugoira_path(save_dir: Path, illust_id: str, fmt: Optional[str]) -> Path:
+  """动图的保存路径，fmt 为 None 时是原始压缩包"""
+  ext = "zip" if fmt is None else "webp" if fmt == "webp" else "png"
+  return save_dir / f"{illust_id}_ugoira.{ext}"
+
+
+class UgoiraDownloader:
+  """
+  动图下载器
+
+  帧从压缩包中流式读取到内存，合成交给进程池，避免阻塞事件循环
+
+  :param parser: API 解析器
+  :param executor: 合成用的进程池，默认新建
+  :param max_workers: 新建进程池时的进程数
+  :param limiter: 按字节计的带宽令牌桶，None 表示不限速
+  """
+
+  def __init__(
+    self,
+    parser: PixivAPIParser,
+    executor: Optional[Executor] = None,
+    max_workers: Optional[int] = None,
+    limiter: Optional[RateLimiter] = None,
+  ):
+    self.parser = parser
+    self.limiter = limiter
+    self._own_executor = executor is None
+    self.executor = executor or ProcessPoolExecutor(max_workers=max_workers)
+
+  async def __aenter__(self) -> "UgoiraDownloader":
+    return self
+
+  async def __aexit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  def close(self) -> None:
+    if self._own_executor:
+      self.executor.shutdown(wait=True)
+
+  async def _iter_download(self, url: str) -> AsyncIterator[bytes]:
+    async for chunk in self.parser.iter_download(url):
+      if self.limiter:
+        await self.limiter.acquire(len(chunk))
+      yield chunk
+
+  async def fetch_frames(self, meta: UgoiraMeta, original: bool = True) -> list[bytes]:
+    """下载压缩包并按 meta 的帧顺序返回帧内容"""
+    url = meta.original_src if original else meta.src
+    files: dict[str, bytes] = {}
+    with span("ugoira_fetch"):
+      async for name, data in iter_zip_frames(self._iter_download(url)):
+        files[name] = data
+
+    missing = [f.file for f in meta.frames if f.file not in files]
+    if missing:
+      raise UgoiraError(f"压缩包缺少帧: {missing[:3]}")
+    return [files[f.file] for f in meta.frames]
+
+  async def download(
+    self,
+    illust_id: str,
+    save_dir: Path,
+    fmt: Optional[str] = "webp",
+    original: bool = True,
+  ) -> Path:
+    """
+    下载动图
+
+    :param illust_id: 插画 ID
+    :param save_dir: 保存目录
+    :param fmt: 合成格式 (webp / apng)，None 表示直接保存原始压缩包
+    :param original: 是否使用原尺寸压缩包
+    :return: 保存路径
+    """
+    meta = await self.parser.get_ugoira_meta(illust_id)
+    url = meta.original_src if original else meta.src
+
+    if fmt is None:
+      out_path = ugoira_path(save_dir, illust_id, None)
+      with span("ugoira_fetch"):
+        await save_stream(out_path, self._iter_download(url))
+      return out_path
+
+    if fmt not in ANIMATION_FORMATS:
+      raise UgoiraError(f"不支持的动图格式: {fmt}")
+
+    frames = await self.fetch_frames(meta, original)
+    delays = [f.delay for f in meta.frames]
+    out_path = ugoira_path(save_dir, illust_id, fmt)
+    await AsyncPath(save_dir).mkdir(parents=True, exist_ok=True)
+
+    loop = asyncio.get_running_loop()
+    with span("ugoira_assemble"):
+      await loop.run_in_executor(self.executor, assemble_animation, frames, delays, str(out_path), fmt)
+    return out_path
@@ -1,17 +1,44 @@
 import asyncio
+import gc
 import hashlib
+import mmap
 import re
+import time
 import traceback
-from datetime import datetime, timezone
+from datetime import datetime
 from pathlib import Path
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, Optional
 
+import anyio
+from anyio import Path as AsyncPath
 from tortoise.exceptions import IntegrityError
 from tortoise.transactions import in_transaction
 
+from counters import apply_image_deltas
+from metrics import DB_BATCH_LATENCY, PROCESS_RSS, RETRIES, ROWS_INSERTED
 from models.api import Illust
 from models.db import Image
+from sql import is_sqlite
 
 FILENAME_MAX_LENGTH = 200
+HASH_CHUNK_SIZE = 1024 * 1024
+UGOIRA_TYPE = 2  # Illust.illust_type 动图
+INSERT_LOCK_KEY = 0x706978  # postgres advisory lock，串行化各进程的 查重 -> 插入 -> 计数
+
+
+InsertListener = Callable[[list[Image]], Awaitable[None]]
+_insert_listeners: list[InsertListener] = []
+
+
+def add_insert_listener(listener: InsertListener) -> None:
+  """注册入库回调，每批插入成功后调用（例如失效缓存）"""
+  if listener not in _insert_listeners:
+    _insert_listeners.append(listener)
+
+
+def remove_insert_listener(listener: InsertListener) -> None:
+  if listener in _insert_listeners:
+    _insert_listeners.remove(listener)
 
 
 def is_token_expired(data):
@@ -28,6 +55,98 @@ def is_token_expired(data):
     return True
 
 
+class RateLimiter:
+  """
+  异步令牌桶
+
+  :param rate: 每秒补充的令牌数
+  :param burst: 桶容量（允许的突发量），默认等于 rate
+  """
+
+  def __init__(self, rate: float, burst: float | None = None):
+    self.rate = rate
+    self.capacity = burst if burst is not None else max(rate, 1)
+    self._tokens = self.capacity
+    self._last = time.monotonic()
+    self._lock = asyncio.Lock()
+
+  def _refill(self) -> None:
+    now = time.monotonic()
+    self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+    self._last = now
+
+  def available(self) -> float:
+    """当前可用的令牌数"""
+    self._refill()
+    return self._tokens
+
+  async def acquire(self, tokens: float = 1) -> None:
+    """取出令牌，不足时等待；超过桶容量的请求会被拆成多次"""
+    async with self._lock:
+      while tokens > 0:
+        self._refill()
+        take = min(tokens, self.capacity)
+        if self._tokens >= take:
+          self._tokens -= take
+          tokens -= take
+          continue
+        await asyncio.sleep((take - self._tokens) / self.rate)
+
+
+def rss_bytes() -> Optional[int]:
+  """当前进程的常驻内存（读取 /proc/self/statm，非 Linux 返回 None）"""
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * mmap.PAGESIZE
+  except (OSError, ValueError, IndexError):
+    return None
+
+
+class MemoryGuard:
+  """
+  内存上限：常驻内存超过上限时暂停上游抓取，等下游消化积压
+
+  Python 释放的内存不一定归还给系统，RSS 可能降不回上限以下，
+  因此下游已经清空时也会放行，避免永久暂停
+
+  :param limit: 上限（字节），None 表示只记录不限制
+  :param interval: 暂停期间的检查间隔（秒）
+  """
+
+  def __init__(self, limit: Optional[int] = None, interval: float = 0.5):
+    self.limit = limit
+    self.interval = interval
+    self.peak = 0
+    self.pauses = 0
+
+  def check(self) -> Optional[int]:
+    """采样一次 RSS 并记录峰值"""
+    rss = rss_bytes()
+    if rss is not None:
+      self.peak = max(self.peak, rss)
+      PROCESS_RSS.set(rss)
+    return rss
+
+  def over_limit(self) -> bool:
+    rss = self.check()
+    return self.limit is not None and rss is not None and rss > self.limit
+
+  async def wait(self, drained: Optional[Callable[[], bool]] = None) -> None:
+    """
+    超过上限时等待，直到 RSS 回落或下游清空
+
+    :param drained: 返回下游是否已清空
+    """
+    if not self.over_limit():
+      return
+    self.pauses += 1
+    print(f"⏸️ 内存 {(rss_bytes() or 0) >> 20} MiB 超过上限 {(self.limit or 0) >> 20} MiB，暂停抓取")
+    gc.collect()
+    while self.over_limit() and not (drained and drained()):
+      await asyncio.sleep(self.interval)
+    print("▶️ 继续抓取")
+
+
 def sanitize_filename(title: str) -> str:
   """清理文件名中的非法字符"""
   # 移除特殊字符并限制长度
@@ -39,13 +158,48 @@ def make_folder(save_dir: Path, userid: int):
   return save_dir / str(userid)
 
 
+def image_path(save_dir: Path, image: Image) -> Path:
+  """图片的本地保存路径: 下载目录/画师ID/作品ID_p页码.扩展名"""
+  return make_folder(save_dir, image.user_id) / f"{image.img_id}_p{image.page}.{image.file_ext or 'jpg'}"
+
+
+def part_path(path: Path) -> Path:
+  """写入中的临时文件路径，写完再改名为 path，中断时不会留下半个文件被当成已下载"""
+  return path.with_name(path.name + ".part")
+
+
+async def save_stream(path: Path, chunks: AsyncIterable[bytes]) -> None:
+  """
+  流式写入文件：先写 .part 再改名；出错或被取消时删除临时文件。文件操作都在线程中执行，不阻塞事件循环
+
+  :param path: 保存路径
+  :param chunks: 文件内容
+  """
+  tmp = AsyncPath(part_path(path))
+  try:
+    await tmp.parent.mkdir(parents=True, exist_ok=True)
+    async with await anyio.open_file(tmp, "wb") as f:
+      async for chunk in chunks:
+        await f.write(chunk)
+    await tmp.replace(path)
+  except BaseException:
+    with anyio.CancelScope(shield=True):
+      await tmp.unlink(missing_ok=True)
+    raise
+
+
 def sha256_from_bytes(stream: bytes | Path) -> str:
-  """对字节内容计算 SHA-256 哈希"""
+  """对字节内容计算 SHA-256 哈希（文件使用 mmap 读取）"""
   if isinstance(stream, Path):
     hash_obj = hashlib.sha256()
     with open(stream, "rb") as f:
-      for chunk in iter(lambda: f.read(4096), b""):
-        hash_obj.update(chunk)
+      try:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+          hash_obj.update(mm)
+      except ValueError:
+        # 空文件无法 mmap
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+          hash_obj.update(chunk)
     return hash_obj.hexdigest()
   else:
     hash_obj = hashlib.sha256(stream)
@@ -72,7 +226,7 @@ async def create_image_from_illust(illust: Illust) -> Image:
       user_avatar=illust.profile_image_url,
       width=illust.width,
       height=illust.height,
-      bookmarks=illust.bookmark_data.get("count") if illust.bookmark_data else 0,
+      bookmarks=0,  # bookmark_data 是当前账号自己的收藏, 公开收藏数由 refresher 回填
       views=0,
       source="pixiv",
       x_restrict=illust.x_restrict,
@@ -87,23 +241,32 @@ async def create_image_from_illust(illust: Illust) -> Image:
   return image
 
 
-async def batch_create_images(illust_list: list, batch_size=100, retry_on_fail=True, max_retries=3):
+async def _iter_items(items: Iterable | AsyncIterable) -> AsyncIterator:
+  if isinstance(items, AsyncIterable):
+    async for item in items:
+      yield item
+  else:
+    for item in items:
+      yield item
+
+
+async def batch_create_images(
+  illust_list: Iterable[Illust] | AsyncIterable[Illust], batch_size=100, retry_on_fail=True, max_retries=3
+):
   """
   批量创建图片记录（自动过滤重复项，支持出错重试）
-  :param illust_list: Pixiv API返回的作品列表
+  :param illust_list: Pixiv API返回的作品列表，或逐个产出作品的异步迭代器（内存中最多保留一批）
   :param batch_size: 每批插入数量（建议100-500）
   :param retry_on_fail: 插入失败时是否尝试重试
   :param max_retries: 最大重试次数
   """
-  if not illust_list:
+  if isinstance(illust_list, list) and not illust_list:
     return
 
   image_objs = []
   illust_count = 0
 
-  now = datetime.now(timezone.utc)
-
-  for illust in illust_list:
+  async for illust in _iter_items(illust_list):
     illust_count += 1
     try:
       # 提取文件扩展名
@@ -125,7 +288,7 @@ async def batch_create_images(illust_list: list, batch_size=100, retry_on_fail=T
             img_id=illust.id,
             title=illust.title[:255],
             tags=illust.tags,
-            meta={},
+            meta={"ugoira": True} if illust.illust_type == UGOIRA_TYPE else {},
             user_id=illust.user_id,
             user_name=illust.user_name[:255],
             user_avatar=illust.profile_image_url,
@@ -135,13 +298,13 @@ async def batch_create_images(illust_list: list, batch_size=100, retry_on_fail=T
             page=page,
             urls=urls,
             description=illust.description,
-            bookmarks=illust.bookmark_data.get("count", 0) if illust.bookmark_data else 0,
+            bookmarks=0,  # bookmark_data 是当前账号自己的收藏, 公开收藏数由 refresher 回填
             views=0,
             source="pixiv",
             x_restrict=illust.x_restrict,
             ai_type=illust.ai_type,
             created=illust.create_date,
-            updated=now,
+            # updated 是 auto_now 字段，每批写入时由 ORM 填入当前时间（流式爬取可能持续数小时，不能用开始时间）
             file_ext=file_ext,
             hash="",
             score=-100,
@@ -163,19 +326,47 @@ async def batch_create_images(illust_list: list, batch_size=100, retry_on_fail=T
     await insert_batch(image_objs, illust_count, retry_on_fail, max_retries)
 
 
+async def filter_new_images(image_objs: list[Image], conn) -> list[Image]:
+  """剔除库中已有以及批内重复的 (img_id, page)，计数只统计真正新增的行"""
+  img_ids = list({obj.img_id for obj in image_objs})
+  seen = set(await Image.filter(img_id__in=img_ids).using_db(conn).values_list("img_id", "page"))
+  new_objs = []
+  for obj in image_objs:
+    key = (obj.img_id, obj.page)
+    if key not in seen:
+      seen.add(key)
+      new_objs.append(obj)
+  return new_objs
+
+
 async def insert_batch(image_objs: list, i: int, retry_on_fail: bool, max_retries: int):
   retries = 0
   while retries <= max_retries:
     try:
-      async with in_transaction():
-        # print(f"📤 正在插入 {len(image_objs)} 条图片（进度：{i}）")
-        await Image.bulk_create(image_objs, ignore_conflicts=True)
+      with DB_BATCH_LATENCY.time():
+        async with in_transaction() as conn:
+          # print(f"📤 正在插入 {len(image_objs)} 条图片（进度：{i}）")
+          # 查重和插入之间若有其他写入者插入同一行，ignore_conflicts 会跳过它，但计数仍会按新增累加；
+          # postgres 用事务级 advisory lock 串行化这一段（锁到提交为止，之后的查重能看到已提交的行）。
+          # sqlite 的 WAL 下延迟事务从读升级为写时，若快照已被其他连接的提交作废会报 BUSY，本批整体重试，不会多计
+          if not is_sqlite():
+            await conn.execute_query("SELECT pg_advisory_xact_lock($1)", [INSERT_LOCK_KEY])
+          new_objs = await filter_new_images(image_objs, conn)
+          await Image.bulk_create(new_objs, ignore_conflicts=True, using_db=conn)
+          await apply_image_deltas(new_objs, conn)
+      ROWS_INSERTED.inc(len(new_objs))
+      for listener in _insert_listeners:
+        try:
+          await listener(image_objs)
+        except Exception as e:
+          print(f"⚠️ 入库回调失败：{e}")
       return  # 插入成功，直接返回
     except Exception as e:
       print(f"⚠️ 批量插入失败：{e}")
       traceback.print_exc()
       retries += 1
       if retry_on_fail and retries <= max_retries:
+        RETRIES.inc(stage="db_insert")
         print(f"🔁 重试插入（{retries}/{max_retries}）...")
         await asyncio.sleep(1)  # 简单延迟
       else: